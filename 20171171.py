@@ -1,18 +1,24 @@
+import concurrent.futures
+import heapq
+import io
+import json
+import math
 import operator
-from collections import defaultdict
-from statistics import mean
+import re
+import socketserver
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from itertools import compress, islice, repeat
+import mmap
+import os
+import pickle
+import struct
 import sys
-import sqlparse
-from sqlparse import sql
-from sqlparse import tokens as T
+import tempfile
 
 
-attribute_tokens = []
-table_tokens = []
-condition_tokens = []
-logical_op = None
-distinct = False
-wildcard_star = None
 relational_ops = {
     '!=': operator.ne,
     '=': operator.eq,
@@ -21,350 +27,2071 @@ relational_ops = {
     '<': operator.lt,
     '<=': operator.le,
 } # relational_ops[$input](var1, var2) gives bool result
+flipped_ops = {
+    '=': '=',
+    '>': '<',
+    '>=': '<=',
+    '<': '>',
+    '<=': '>=',
+} # (const op attr) is (attr flipped_ops[op] const); != is missing as no index can serve it
 aggregate_ops = {
-    'MAX': max,
-    'MIN': min,
-    'SUM': sum,
-    'AVG': mean,
-} # aggregate_ops[$input](list)
+    'COUNT': operator.itemgetter(0),
+    'MAX': operator.itemgetter(3),
+    'MIN': operator.itemgetter(2),
+    'SUM': operator.itemgetter(1),
+    'AVG': lambda state: None if not state[0] else state[1] // state[0] if state[1] % state[0] == 0 else state[1] / state[0],
+} # aggregate_ops[$input](state) gives aggregate of merged (count, sum, min, max) state, None over no rows
 
 
-TABLES = defaultdict(dict)
 DIR_PATH = "./files"
-JOIN_ATTR_LIST = []
+SERVER_PORT = 5433
+END_OF_RESULT = ";" # terminates every result sent by the server
+BATCH_SIZE = 8192
+PARTITION_SIZE = 65536 # rows filtered by one worker process task
+ZONE_SIZE = BATCH_SIZE # rows per block of zone maps; scan batches and partitions are whole blocks
+CACHE_MAGIC = b"MSQLCOL2"
+CACHE_HEADER = struct.Struct("=8sqqqq") # magic, csv size, csv mtime, rows, schema length
+INDEX_MAGIC = b"MSQLIDX1"
+INDEX_HEADER = struct.Struct("=8sqqq") # magic, csv size, csv mtime, rows
+INDEX_SCAN_RATIO = 8 # an index is used only if it leaves fewer than 1 / INDEX_SCAN_RATIO of the rows
+BLOOM_SLOTS_PER_KEY = 8 # at least, so about 1 - e ** (-1 / 8) of the keys not in a Bloom filter pass it
+BLOOM_FALSE_POSITIVES = 0.12
+BLOOM_FILTER_COST = 0.8 # filtering a row by a Bloom filter costs about 0.8 times copying and probing it, measured by benchmarks/bloom_join.py
+SAMPLE_SIZE = 1024 # rows sampled per table by the join planner
+STATISTICS_FILE = "statistics.json" # written by analyze next to metadata.txt
+HLL_BITS = 12 # HyperLogLog sketches of distinct values have 2 ** HLL_BITS registers
+HISTOGRAM_BUCKETS = 32
+HISTOGRAM_SAMPLE = 1 << 14 # values per column sampled by analyze to build equi-depth histograms
+DEFAULT_SELECTIVITY = 1 / 3 # fraction of rows estimated to satisfy a condition statistics say nothing about
+STANDARD_QUERY = "Standard Query: select * from table_name where condition;"
+PLAN_CACHE_SIZE = 256
+GROUP_LIMIT = 1 << 20 # groups held in memory by hash aggregation before they are spilled to disk
+SPILL_PARTITIONS = 16
+DISTINCT_LIMIT = 1 << 20 # distinct rows held in memory before DISTINCT sorts the rest on disk
+SORT_LIMIT = 1 << 20 # rows sorted in memory by ORDER BY before sorted runs are written to disk
+MERGE_FANIN = 64 # sorted runs on disk merged at once
+LITERAL_PATTERN = re.compile(r"(?<![\w.])-?\d+(?![\w.])") # integer literals, not digits inside names
+TOKEN_PATTERN = re.compile(r"\s*(?:(?P<number>-?\d+)|(?P<name>[A-Za-z_][\w$]*)|(?P<op><=|>=|!=|<>|=|<|>)|(?P<symbol>[*,.();])|(?P<other>\S))")
+KEYWORDS = {"EXPLAIN", "SELECT", "DISTINCT", "FROM", "WHERE", "AND", "OR", "GROUP", "BY", "ORDER", "ASC", "DESC", "LIMIT"}
 
 
-def join(table1, table2):
-    """Returns CROSS JOIN of table1 and table2"""
+class QueryError(Exception):
+    """Error in a query or in the tables it reads; str() is the message shown to the user, e.g. "AttributeError: ..." """
 
+    def __init__(self, message, exit_code=1):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+    def __reduce__(self):
+        return QueryError, (str(self), self.exit_code)
+
+
+class Column(namedtuple("Column", "table name")):
+    """Attribute [table.]name in a query, table is None when not qualified"""
+
+    @property
+    def value(self):
+        return self.name if self.table is None else self.table + "." + self.name
+
+
+Aggregate = namedtuple("Aggregate", "function column") # function name as written, e.g. max(A); column None for count(*)
+Condition = namedtuple("Condition", "operand1 op operand2") # operands are Column or int
+
+
+class QueryContext:
+    """State of one query: its parsed syntax tree and the tables of the engine running it"""
+
+    def __init__(self, engine, tables, syntax_tree):
+        self.engine = engine
+        self.tables = tables
+        self.attribute_nodes = syntax_tree["attributes"]
+        self.table_names = syntax_tree["tables"]
+        self.condition_nodes = syntax_tree["conditions"]
+        self.group_by_nodes = syntax_tree["group_by"]
+        self.order_by_nodes = syntax_tree["order_by"]
+        self.limit = syntax_tree["limit"]
+        self.explain = syntax_tree["explain"]
+        self.logical_op = syntax_tree["logical_op"]
+        self.distinct = syntax_tree["distinct"]
+        self.wildcard_star = syntax_tree["wildcard_star"]
+        self.join_attr_list = []
+
+
+class QueryResult:
+    """Iterator over the rows (tuples of ints) of an executed query, with the names of its columns in attributes"""
+
+    def __init__(self, attributes, rows):
+        self.attributes = attributes
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.rows)
+
+
+def to_array(column):
+    """Returns column as an array, copying it if it is a view of a binary column cache"""
+
+    if isinstance(column, array):
+        return column
+    column_array = array('q')
+    column_array.frombytes(column.cast('B'))
+    return column_array
+
+
+def get_table(attributes, columns, size):
+    """Returns table with given attributes and typed column arrays of given number of rows"""
+
+    table = defaultdict(dict)
+    table["attributes"] = attributes
+    table["columns"] = columns
+    table["size"] = size
+    return table
+
+
+def gather(table, row_ids):
+    """Returns rows of table at given row ids, in that order"""
+
+    columns = [array('q', map(column.__getitem__, row_ids)) for column in table["columns"]]
+    return get_table(table["attributes"], columns, len(row_ids))
+
+
+def concat_row_ids(batches):
+    """Returns (row ids of table1, row ids of table2) made of given batches of row id pairs in order"""
+
+    row_ids_a = array('q')
+    row_ids_b = array('q')
+    for batch_a, batch_b in batches:
+        row_ids_a.extend(batch_a)
+        row_ids_b.extend(batch_b)
+    return row_ids_a, row_ids_b
+
+
+def join_batches(table1, table2, join_keys=None, build_left=False):
+    """Yields (row ids of table1, row ids of table2) of joined row pairs in batches of about BATCH_SIZE probed rows"""
+
+    # A hash join on equality join_keys [(idx1, idx2)], built on table1 if build_left else on table2; without them a cross join
+    try:
+        if not join_keys:
+            rows_per_batch = max(1, BATCH_SIZE // max(1, table2["size"]))
+            for start in range(0, table1["size"], rows_per_batch):
+                stop = min(start + rows_per_batch, table1["size"])
+                row_ids_a = array('q')
+                for row_id in range(start, stop):
+                    row_ids_a.extend(repeat(row_id, table2["size"]))
+                yield row_ids_a, array('q', range(table2["size"])) * (stop - start)
+            return
+
+        keys_a = [table1["columns"][idx_a] for idx_a, _ in join_keys]
+        keys_b = [table2["columns"][idx_b] for _, idx_b in join_keys]
+        keys_a = keys_a[0] if len(keys_a) == 1 else zip(*keys_a)
+        keys_b = keys_b[0] if len(keys_b) == 1 else zip(*keys_b)
+
+        # Built on table1 rows come out in the order of table2, built on table2 in nested loop order
+        build_keys, probe_keys, probe_size = (keys_a, iter(keys_b), table2["size"]) if build_left else (keys_b, iter(keys_a), table1["size"])
+        hash_table = defaultdict(list)
+        for row_id, key in enumerate(build_keys):
+            hash_table[key].append(row_id)
+
+        for start in range(0, probe_size, BATCH_SIZE):
+            build_row_ids = array('q')
+            probe_row_ids = array('q')
+            # The range comes first so zip() stops without taking a key of the next batch
+            for row_id, key in zip(range(start, min(start + BATCH_SIZE, probe_size)), probe_keys):
+                matches = hash_table.get(key)
+                if matches:
+                    build_row_ids.extend(matches)
+                    probe_row_ids.extend(repeat(row_id, len(matches)))
+            yield (build_row_ids, probe_row_ids) if build_left else (probe_row_ids, build_row_ids)
+    except Exception as e:
+        raise QueryError("JoinError: " + str(e))
+
+
+def index_join_batches(table1, idx1, index):
+    """Yields (row ids of table1, row ids of table2) joining column idx1 of table1 to the indexed column of table2"""
+
+    # Every row of table1 is looked up in the index, BATCH_SIZE rows per batch
+    values, index_row_ids = index
     try:
-        joined_table = defaultdict(dict)
-        joined_table["attributes"] = table1["attributes"] + table2["attributes"]
-        joined_table["rows"] = []
-        for row_a in table1["rows"]:
-            for row_b in table2["rows"]:
-                joined_table["rows"].append(row_a + row_b)
+        column = table1["columns"][idx1]
+        for start in range(0, table1["size"], BATCH_SIZE):
+            row_ids_a = array('q')
+            row_ids_b = array('q')
+            for row_id in range(start, min(start + BATCH_SIZE, table1["size"])):
+                key = column[row_id]
+                start_idx = bisect_left(values, key)
+                stop_idx = bisect_right(values, key, start_idx)
+                if start_idx < stop_idx:
+                    # Equal values are indexed in row order, so rows come out in nested loop order as in join_batches() built on table2
+                    row_ids_a.extend(repeat(row_id, stop_idx - start_idx))
+                    row_ids_b.extend(index_row_ids[start_idx:stop_idx])
+            yield row_ids_a, row_ids_b
     except Exception as e:
-        print("JoinError:", str(e))
-        exit(1)
-    return joined_table
+        raise QueryError("JoinError: " + str(e))
 
 
-def get_column_table(token):
-    """Returns table_name to which given attribute[token] belongs"""
+def gather_joined(tables, row_ids, sources):
+    """Returns columns at (table position, column idx) sources of the joined rows at row_ids (all rows if None)"""
 
-    global TABLES
+    columns = []
+    for position, idx in sources:
+        column = tables[position]["columns"][idx]
+        columns.append(column if row_ids[position] is None else array('q', map(column.__getitem__, row_ids[position])))
+    return columns
+
+
+def get_column_table(context, column):
+    """Returns table_name to which given attribute[column] belongs"""
 
     col_tables = []
-    for table in [t.value for t in table_tokens]:
-        if token.value in [name[len(table) + 1:] for name in TABLES[table]["attributes"]]:
+    for table in context.table_names:
+        if column.value in [name[len(table) + 1:] for name in context.tables[table]["attributes"]]:
             col_tables.append(table)
     
     if len(col_tables) > 1:
-        print("AttributeError: Ambiguous attribute name", token.value + ",", "corresponding table_name not specified")
-        exit(1)
+        raise QueryError("AttributeError: Ambiguous attribute name " + column.value + ", corresponding table_name not specified")
     return None if not col_tables else col_tables[0]
 
 
-def apply_condition(output):
-    """Applies conditions given in WHERE clause to resulting output of CROSS JOIN, i.e., filters result"""
-
-    global JOIN_ATTR_LIST, condition_tokens, relational_ops, logical_op
-
-    filtered_output = defaultdict(dict)
-    filtered_output["attributes"] = output["attributes"]
-    filtered_output["rows"] = []
-
-    for row in output["rows"]:
-        should_include = None
-        
-        for condition_token in condition_tokens:
-            var1, var2, op = 3*[None]
-            iden_cnt = 0
-
-            try:
-                for token in condition_token.tokens:
-                    if isinstance(token, sql.Identifier):
-                        check_attribute(token)
-                        attr_name = token.value if token.get_parent_name() else str(get_column_table(token) + "." + token.get_real_name())
-                        if var1 is None:
-                            var1 = row[output["attributes"].index(attr_name)]
-                        else:
-                            var2 = row[output["attributes"].index(attr_name)]
-                        if iden_cnt:
-                            if attr_name not in JOIN_ATTR_LIST:
-                                JOIN_ATTR_LIST.append(attr_name)
-                        iden_cnt += 1
-                    elif token.ttype is T.Comparison:
-                        op = token.value
-                    elif token.ttype is T.Number.Integer:
-                        if var1 is None:
-                            var1 = int(token.value)
-                        else:
-                            var2 = int(token.value)
-            except Exception as e:
-                print("ConditionParsingError:", str(e))
-                exit(1)
-
-            if op != "=":
-                JOIN_ATTR_LIST = []
-
-            truth_val = relational_ops[op](var1, var2)
-            if should_include is None:
-                should_include = truth_val
-                if logical_op is None:
-                    break
-            else:
-                if logical_op == "AND":
-                    should_include = should_include and truth_val
-                elif logical_op == "OR":
-                    should_include = should_include or truth_val
-        
-        if not condition_tokens:
-            should_include = True
-        if should_include:
-            filtered_output["rows"].append(row)
+def get_attribute_name(context, column):
+    """Returns table qualified name of given attribute[column]"""
+
+    return column.value if column.table else str(get_column_table(context, column) + "." + column.name)
+
+
+def get_condition(context, condition_node):
+    """Returns (operand1, op, operand2) of given WHERE condition, attributes as qualified names and constants as ints"""
+
+    operands = []
+    for operand in (condition_node.operand1, condition_node.operand2):
+        if isinstance(operand, Column):
+            check_attribute(context, operand)
+            operands.append(get_attribute_name(context, operand))
+        else:
+            operands.append(operand)
+
+    if condition_node.op not in relational_ops:
+        text = " ".join(operand.value if isinstance(operand, Column) else str(operand) for operand in (condition_node.operand1, condition_node.operand2))
+        raise QueryError("ConditionParsingError: Invalid condition " + text.replace(" ", " " + condition_node.op + " ", 1))
+
+    return operands[0], condition_node.op, operands[1]
+
+
+def get_join_keys(table1, table2, conditions, logical_op):
+    """Returns [(idx1, idx2)] of equality conditions between columns of table1 and table2, usable as hash join keys"""
+
+    if logical_op == "OR":
+        return []
+
+    join_keys = []
+    for operand1, op, operand2 in conditions:
+        if op != "=" or not isinstance(operand1, str) or not isinstance(operand2, str):
+            continue
+
+        # An attribute already present in table1 resolves to table1, as in apply_condition()
+        sides = [0 if attr_name in table1["attributes"] else 1 if attr_name in table2["attributes"] else None for attr_name in (operand1, operand2)]
+        if sides == [0, 1]:
+            join_keys.append((table1["attributes"].index(operand1), table2["attributes"].index(operand2)))
+        elif sides == [1, 0]:
+            join_keys.append((table1["attributes"].index(operand2), table2["attributes"].index(operand1)))
+
+    return join_keys
+
+
+def plan_conditions(context):
+    """Returns WHERE conditions, {table_name: condition ids} pushed down to table scans and residual condition ids"""
+
+    pushed_conditions = defaultdict(list)
+    residual_conditions = []
+
+    conditions = [get_condition(context, condition_node) for condition_node in context.condition_nodes]
+    if context.logical_op is None:
+        conditions = conditions[:1]
+    condition_tables = []
+
+    for operand1, op, operand2 in conditions:
+        attr_names = [operand for operand in (operand1, operand2) if isinstance(operand, str)]
+        condition_tables.append(set(attr_name[:attr_name.index(".")] for attr_name in attr_names))
+        if len(attr_names) == 2 and attr_names[1] not in context.join_attr_list:
+            context.join_attr_list.append(attr_names[1])
+        if op != "=":
+            context.join_attr_list = []
+
+    # OR can only be pushed down as a whole, i.e. when every condition touches the same single table
+    if context.logical_op == "OR":
+        tables = set.union(*condition_tables)
+        if len(tables) == 1:
+            pushed_conditions[tables.pop()] = list(range(len(conditions)))
+        else:
+            residual_conditions = list(range(len(conditions)))
+        return conditions, dict(pushed_conditions), residual_conditions
+
+    for condition_id, tables in enumerate(condition_tables):
+        if len(tables) == 1:
+            pushed_conditions[next(iter(tables))].append(condition_id)
+        else:
+            residual_conditions.append(condition_id)
+    return conditions, dict(pushed_conditions), residual_conditions
+
+
+def compile_condition(condition, attributes):
+    """Returns function (columns, size) -> bool mask of (operand1, op, operand2) condition over given attributes"""
+
+    operand1, op, operand2 = condition
+    op = relational_ops[op]
+
+    if isinstance(operand1, str):
+        idx1 = attributes.index(operand1)
+        if isinstance(operand2, str):
+            idx2 = attributes.index(operand2)
+            return lambda columns, size: map(op, columns[idx1], columns[idx2])
+        return lambda columns, size: map(op, columns[idx1], repeat(operand2, size))
+    if isinstance(operand2, str):
+        idx2 = attributes.index(operand2)
+        return lambda columns, size: map(op, repeat(operand1, size), columns[idx2])
+    truth_val = op(operand1, operand2)
+    return lambda columns, size: repeat(truth_val, size)
+
+
+def compile_conditions(conditions, attributes, logical_op):
+    """Returns single function (columns, size) -> bool mask combining given conditions with the WHERE logical_op"""
+
+    masks = [compile_condition(condition, attributes) for condition in conditions]
+    if not masks:
+        return lambda columns, size: repeat(True, size)
+    if len(masks) == 1:
+        return masks[0]
+
+    mask1, mask2 = masks
+    combine = operator.or_ if logical_op == "OR" else operator.and_
+    return lambda columns, size: map(combine, mask1(columns, size), mask2(columns, size))
+
+
+def apply_condition(output, conditions, logical_op):
+    """Applies given conditions of WHERE clause to output of table scan or CROSS JOIN, i.e., filters result"""
+
+    if not conditions:
+        return output
+
+    get_mask = compile_conditions(conditions, output["attributes"], logical_op)
+    mask = bytes(get_mask(output["columns"], output["size"]))
+    columns = [array('q', compress(column, mask)) for column in output["columns"]]
+    return get_table(output["attributes"], columns, mask.count(1))
+
+
+def load_partition(partition):
+    """Returns table of row partition: a table or (files_dir, table_name, schema, attributes, start, stop) of its cache"""
+
+    if isinstance(partition, dict):
+        return partition
+
+    files_dir, table_name, schema, attributes, start, stop = partition
+    cache = read_cache_header(files_dir, table_name, schema)
+    if cache is None:
+        raise QueryError("TabledataReadingError: " + table_name + ".csv changed during scan")
+    return read_cache_columns(cache, schema, attributes, start, stop)
+
+
+def get_prime_at_least(number):
+    """Returns smallest prime not below number"""
+
+    number = max(2, number)
+    while any(number % divisor == 0 for divisor in range(2, math.isqrt(number) + 1)):
+        number += 1
+    return number
+
+
+def build_bloom_filter(keys):
+    """Returns Bloom filter of given keys, a byte per slot, BLOOM_SLOTS_PER_KEY slots per key"""
+
+    keys = set(keys)
+    slots = bytearray(get_prime_at_least(len(keys) * BLOOM_SLOTS_PER_KEY))
+    for slot_id in map(operator.mod, keys, repeat(len(slots))):
+        slots[slot_id] = 1
+    return bytes(slots)
+
+
+def get_bloom_mask(bloom_filter, column):
+    """Returns iterator of 1 for values of column that may be keys of Bloom filter, 0 for the others"""
+
+    # One modulo and one lookup per value, both in C; a prime length spreads keys spaced by any stride
+    return map(bloom_filter.__getitem__, map(operator.mod, column, repeat(len(bloom_filter))))
+
+
+def apply_bloom_filter(table, idx, bloom_filter):
+    """Returns rows of table whose column idx may hold a key of Bloom filter, dropping the rest"""
 
-    return filtered_output
+    mask = bytes(get_bloom_mask(bloom_filter, table["columns"][idx]))
+    return get_table(table["attributes"], [array('q', compress(column, mask)) for column in table["columns"]], mask.count(1))
 
 
-def print_output(filtered_output):
-    """Projects given attributes and prints final result"""
+def filter_partition(partition, conditions, logical_op, idx_list, bloom=None):
+    """Filters and projects one row partition in a worker process, also by (idx, Bloom filter) of a join key if given"""
+
+    table = load_partition(partition)
+    mask = compile_conditions(conditions, table["attributes"], logical_op)(table["columns"], table["size"])
+    if bloom is not None:
+        # Conditions and Bloom filter make one mask, so kept rows are copied once
+        idx, bloom_filter = bloom
+        mask = map(operator.and_, mask, get_bloom_mask(bloom_filter, table["columns"][idx]))
+    mask = bytes(mask)
+    return get_table([table["attributes"][idx] for idx in idx_list], [array('q', compress(table["columns"][idx], mask)) for idx in idx_list], mask.count(1))
+
+
+def map_table(engine, table, function, args, partitions=None):
+    """Yields function(partition, *args) of partitions of table in row order, by worker processes if table is large"""
+
+    if engine.workers > 1 and table["size"] > PARTITION_SIZE:
+        if partitions is None:
+            partitions = (get_table(table["attributes"], [to_array(column[start:start + PARTITION_SIZE]) for column in table["columns"]], min(PARTITION_SIZE, table["size"] - start))
+                          for start in range(0, table["size"], PARTITION_SIZE))
+        yield from engine.map_partitions(function, partitions, *args)
+    else:
+        yield function(table, *args)
+
+
+def filter_parts(engine, table, conditions, logical_op, idx_list, partitions=None, bloom=None):
+    """Yields row-ordered parts of table filtered by conditions and (idx, Bloom filter) if given, projected to idx_list"""
+
+    if conditions or bloom is not None:
+        yield from map_table(engine, table, filter_partition, (conditions, logical_op, idx_list, bloom), partitions)
+        return
+    yield get_table([table["attributes"][idx] for idx in idx_list], [table["columns"][idx] for idx in idx_list], table["size"])
+
+
+def concat_parts(attributes, parts):
+    """Returns single table made of given parts in order"""
+
+    parts = list(parts)
+    if len(parts) == 1:
+        return parts[0]
+
+    columns = [array('q') for _ in attributes]
+    for part in parts:
+        for column, part_column in zip(columns, part["columns"]):
+            column.extend(part_column)
+    return get_table(attributes, columns, sum(part["size"] for part in parts))
+
+
+def get_index_range(values, op, value):
+    """Returns [start, stop) of sorted index values v satisfying v op value"""
+
+    if op == "=":
+        return bisect_left(values, value), bisect_right(values, value)
+    if op == "<":
+        return 0, bisect_left(values, value)
+    if op == "<=":
+        return 0, bisect_right(values, value)
+    if op == ">":
+        return bisect_right(values, value), len(values)
+    return bisect_left(values, value), len(values)
+
+
+def index_lookup(engine, table_name, conditions, logical_op):
+    """Returns ascending row ids of table rows that may satisfy conditions by an index, None if none is selective enough"""
+
+    if logical_op == "OR" and len(conditions) > 1:
+        return None
+
+    # The indexed comparison with a constant leaving fewest rows is used
+    best = None
+    for operand1, op, operand2 in conditions:
+        if isinstance(operand1, str) == isinstance(operand2, str) or op not in flipped_ops:
+            continue
+        attr_name, op, value = (operand1, op, operand2) if isinstance(operand1, str) else (operand2, flipped_ops[op], operand1)
+        index = engine.get_index(table_name, attr_name)
+        if index is None:
+            continue
+        start, stop = get_index_range(index[0], op, value)
+        if best is None or stop - start < best[2] - best[1]:
+            best = index, start, stop
+
+    if best is None:
+        return None
+    (values, index_row_ids), start, stop = best
+    if (stop - start) * INDEX_SCAN_RATIO >= len(values):
+        return None
+    return array('q', sorted(index_row_ids[start:stop]))
+
+
+def conditions_never_true(engine, table_name, conditions, logical_op):
+    """Returns whether statistics of table show none of its rows satisfies conditions, so it need not be scanned"""
+
+    statistics = engine.get_statistics(table_name) if conditions else None
+    if statistics is None:
+        return False
+    never_true = [condition_never_true(statistics, condition) for condition in conditions]
+    return all(never_true) if logical_op == "OR" else any(never_true)
+
+
+def index_scan(engine, table, table_name, conditions, logical_op):
+    """Returns rows of table satisfying conditions read through an index, None if no index is selective enough"""
+
+    row_ids = index_lookup(engine, table_name, conditions, logical_op)
+    if row_ids is None:
+        return None
+    return apply_condition(gather(table, row_ids), conditions, logical_op)
+
+
+def get_projection(context, attributes):
+    """Returns (attr_names, idx_list) of the attributes to output out of given table attributes"""
 
-    global JOIN_ATTR_LIST, wildcard_star, attribute_tokens, aggregate_ops
     attr_names = []
     idx_list = []
 
     rem_list = []
-    for attr_name in JOIN_ATTR_LIST:
-        idx = filtered_output["attributes"].index(attr_name)
+    for attr_name in context.join_attr_list:
+        idx = attributes.index(attr_name)
         rem_list.append(idx)
 
-    out_rows = []
-    if wildcard_star:
-        idx_list = range(len(filtered_output["attributes"]))
-        attr_names = filtered_output["attributes"]
-
-    for attribute in attribute_tokens:
-        if type(attribute) == tuple: # Aggr Function
-            attr_name = attribute[1].value if attribute[1].get_parent_name() else str(get_column_table(attribute[1]) + "." + attribute[1].get_real_name())
-            idx = filtered_output["attributes"].index(attr_name)
-
-            temp = []
-            for row in filtered_output["rows"]:
-                temp.append(row[idx])
-            
-            print(attribute[0].value + "(" + attr_name + ")")
-            print(aggregate_ops[attribute[0].value.upper()](temp))
+    if context.wildcard_star:
+        idx_list = range(len(attributes))
+        attr_names = attributes
+
+    for attribute in context.attribute_nodes:
+        attr_name = get_attribute_name(context, attribute)
+        if attr_name in context.join_attr_list:
+            continue
+        idx_list.append(attributes.index(attr_name))
+        attr_names.append(attr_name)
+
+    attr_names = [attr_name for attr_name in attr_names if attr_name not in context.join_attr_list]
+    idx_list = [idx for idx in idx_list if idx not in rem_list]
+    return attr_names, idx_list
+
+
+def get_rows(table, idx_list):
+    """Returns iterator over tuples of given columns of the rows of table"""
+
+    columns = [table["columns"][idx] for idx in idx_list]
+    return zip(*columns) if columns else repeat((), table["size"])
+
+
+def write_run(rows):
+    """Writes rows, in BATCH_SIZE pickled lists, to a new temporary run file and returns it"""
+
+    rows = iter(rows)
+    run_file = tempfile.TemporaryFile()
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if not batch:
+            return run_file
+        pickle.dump(batch, run_file)
+
+
+def add_run(run_files, rows, key=None):
+    """Appends run file of sorted rows to run_files, first merging open runs into one when MERGE_FANIN are open"""
+
+    if len(run_files) >= MERGE_FANIN:
+        merged_run = write_run(heapq.merge(*[read_spill_file(run_file) for run_file in run_files], key=key))
+        for run_file in run_files:
+            run_file.close()
+        run_files[:] = [merged_run]
+    run_files.append(write_run(rows))
+
+
+def distinct_rows(rows, limit=DISTINCT_LIMIT):
+    """Yields first occurrence of every row as soon as it is seen"""
+
+    # Once limit distinct rows are held, the remaining rows are deduplicated by sorted runs on disk and yielded in sorted order at the end
+    rows = iter(rows)
+    used = set()
+    for row in rows:
+        if row not in used:
+            used.add(row)
+            yield row
+            if len(used) >= limit:
+                break
+    else:
+        return
+
+    run_files = []
+    try:
+        while True:
+            chunk = set(islice(rows, limit))
+            if not chunk:
+                break
+            run = sorted(chunk.difference(used))
+            if run:
+                add_run(run_files, run)
+
+        previous = None
+        for row in heapq.merge(*[read_spill_file(run_file) for run_file in run_files]):
+            if row != previous:
+                yield row
+                previous = row
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def get_sort_key(order_by):
+    """Returns key function sorting rows by given [(idx, descending)]"""
+
+    if not any(descending for _, descending in order_by):
+        return operator.itemgetter(*[idx for idx, _ in order_by])
+    return lambda row: tuple(-row[idx] if descending else row[idx] for idx, descending in order_by)
+
+
+def order_rows(rows, order_by, limit, sort_limit):
+    """Yields rows stably sorted by given [(idx, descending)], at most limit of them"""
+
+    # Up to sort_limit top rows are kept in a heap, else runs of sort_limit sorted rows are merged from disk
+    key = get_sort_key(order_by)
+    if limit is not None and limit <= sort_limit:
+        yield from heapq.nsmallest(limit, rows, key=key)
+        return
+
+    rows = iter(rows)
+    run_files = []
+    try:
+        while True:
+            run = sorted(islice(rows, sort_limit), key=key)
+            if not run_files and len(run) < sort_limit:
+                sorted_rows = iter(run)
+                break
+            if not run:
+                sorted_rows = heapq.merge(*[read_spill_file(run_file) for run_file in run_files], key=key)
+                break
+            add_run(run_files, run, key)
+        yield from islice(sorted_rows, limit)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+
+def get_aggregates(context):
+    """Returns Aggregates in SELECT"""
+
+    return [attribute for attribute in context.attribute_nodes if isinstance(attribute, Aggregate)]
+
+
+def get_aggregate_state(function, count, values):
+    """Returns mergeable (count, sum, min, max) state of count values, computing in one pass only the field function needs"""
+
+    if not count:
+        return 0, 0, None, None
+    return (count, sum(values) if function in ("SUM", "AVG") else 0,
+            min(values) if function == "MIN" else None, max(values) if function == "MAX" else None)
+
+
+def merge_aggregate_states(states):
+    """Returns single (count, sum, min, max) state combining given partial states"""
+
+    count, total, minimum, maximum = 0, 0, None, None
+    for state in states:
+        count += state[0]
+        total += state[1]
+        if state[2] is not None:
+            minimum = state[2] if minimum is None else min(minimum, state[2])
+        if state[3] is not None:
+            maximum = state[3] if maximum is None else max(maximum, state[3])
+    return count, total, minimum, maximum
+
+
+def group_partition(partition, conditions, logical_op, group_idx, aggregates):
+    """Returns {group key: [aggregate states]} of the rows of one row partition matching conditions"""
+
+    # aggregates are (function, idx) pairs, idx None for count(*)
+    table = load_partition(partition)
+    if group_idx:
+        table = apply_condition(table, conditions, logical_op)
+        columns = table["columns"]
+        row_ids = defaultdict(list)
+        for row_id, key in enumerate(zip(*[columns[idx] for idx in group_idx])):
+            row_ids[key].append(row_id)
+        return {key: [get_aggregate_state(function, len(ids), idx is not None and map(columns[idx].__getitem__, ids)) for function, idx in aggregates]
+                for key, ids in row_ids.items()}
+
+    # Without GROUP BY the aggregates are accumulated straight from the mask, without copying the matching rows
+    columns = table["columns"]
+    if not conditions:
+        return {(): [get_aggregate_state(function, table["size"], idx is not None and columns[idx]) for function, idx in aggregates]}
+    mask = bytes(compile_conditions(conditions, table["attributes"], logical_op)(columns, table["size"]))
+    return {(): [get_aggregate_state(function, mask.count(1), idx is not None and compress(columns[idx], mask)) for function, idx in aggregates]}
+
+
+def merge_groups(groups, items):
+    """Merges (group key, [aggregate states]) items into groups"""
+
+    for key, states in items:
+        merged = groups.get(key)
+        groups[key] = states if merged is None else [merge_aggregate_states(pair) for pair in zip(merged, states)]
+
+
+def spill_groups(groups, spill_files):
+    """Appends groups to spill files, each group to the file picked by the hash of its key, and empties groups"""
+
+    spilled = [[] for _ in spill_files]
+    for key, states in groups.items():
+        spilled[hash(key) % len(spill_files)].append((key, states))
+    for items, spill_file in zip(spilled, spill_files):
+        if items:
+            pickle.dump(items, spill_file)
+    groups.clear()
+
+
+def read_spill_file(spill_file):
+    """Yields items of the lists pickled to spill file"""
+
+    spill_file.seek(0)
+    while True:
+        try:
+            items = pickle.load(spill_file)
+        except EOFError:
+            break
+        yield from items
+
+
+def hash_aggregate(parts, group_limit):
+    """Yields (group key, [aggregate states]) of groups merged from partial groups of parts"""
+
+    # Once more than group_limit groups are held they are spilled to disk, then merged one spill file at a time
+    groups = {}
+    spill_files = None
+    try:
+        for part in parts:
+            merge_groups(groups, part.items())
+            if len(groups) > group_limit:
+                if spill_files is None:
+                    spill_files = [tempfile.TemporaryFile() for _ in range(SPILL_PARTITIONS)]
+                spill_groups(groups, spill_files)
+
+        if spill_files is None:
+            yield from groups.items()
             return
 
+        spill_groups(groups, spill_files)
+        for spill_file in spill_files:
+            # A group is spilled to the same file every time, so each file holds its groups whole
+            merge_groups(groups, read_spill_file(spill_file))
+            yield from groups.items()
+            groups.clear()
+    finally:
+        for spill_file in spill_files or []:
+            spill_file.close()
+
+
+def aggregate_output(engine, plan):
+    """Yields one row per group of query plan, merged from partial groups of its partitions; without GROUP BY a single row"""
+
+    if len(plan["tables"]) == 1:
+        table_name = plan["tables"][0]
+        attributes = plan["attributes"][table_name]
+        conditions = get_conditions(plan, plan["pushed_conditions"].get(table_name, []) + plan["residual_conditions"])
+    else:
+        # Only the attributes grouped by or aggregated are gathered from the joined rows
+        from_attributes = [attr_name for table_name in plan["tables"] for attr_name in plan["attributes"][table_name]]
+        used_attributes = set(plan["group_by"]) | {attr_name for _, attr_name in plan["aggregates"] if attr_name is not None}
+        idx_list = sorted({from_attributes.index(attr_name) for attr_name in used_attributes})
+        attributes = [from_attributes[idx] for idx in idx_list]
+        conditions = []
+
+    group_idx = [attributes.index(attr_name) for attr_name in plan["group_by"]]
+    aggregates = [(function, None if attr_name is None else attributes.index(attr_name)) for function, attr_name in plan["aggregates"]]
+    args = (conditions, plan["logical_op"], group_idx, aggregates)
+
+    row_ids = index_lookup(engine, plan["tables"][0], conditions, plan["logical_op"]) if len(plan["tables"]) == 1 and conditions else None
+    if len(plan["tables"]) > 1:
+        # Each part of the join is grouped as it is produced, so the joined rows are never held all at once
+        parts = (group_partition(part, *args) for part in join_tables(engine, plan, idx_list))
+    elif conditions_never_true(engine, table_name, conditions, plan["logical_op"]):
+        parts = []
+    elif row_ids is not None:
+        parts = [group_partition(gather(engine.get_table_data(table_name, attributes), row_ids), *args)]
+    else:
+        blocks = engine.get_zone_blocks(table_name, conditions, plan["logical_op"])
+        partitions = engine.get_partitions(table_name, attributes, blocks)
+        if partitions is not None:
+            parts = engine.map_partitions(group_partition, partitions, *args)
         else:
-            attr_name = attribute.value if attribute.get_parent_name() else str(get_column_table(attribute) + "." + attribute.get_real_name())
-            if attr_name in JOIN_ATTR_LIST:
-                continue
-            idx_list.append(filtered_output["attributes"].index(attr_name))
-            attr_names.append(attr_name)
+            parts = (group_partition(batch, *args) for batch in engine.scan_table(table_name, attributes, blocks))
 
-    attr_names[:] = (attr_name for attr_name in attr_names if attr_name not in JOIN_ATTR_LIST)
+    groups = hash_aggregate(parts, engine.group_limit)
+    if not plan["group_by"]:
+        # Over no rows COUNT and SUM are 0 while MAX, MIN and AVG are None, printed as NULL
+        groups = [next(groups, ((), [(0, 0, None, None)] * len(aggregates)))]
 
-    print(",".join(attr_names))
+    for key, states in groups:
+        values = [aggregate_ops[function](state) for (function, _), state in zip(plan["aggregates"], states)]
+        yield tuple(key[idx] if kind == "group" else values[idx] for kind, idx in plan["output"])
 
-    for row in filtered_output["rows"]:
-        temp_row = []
-        for idx in idx_list:
-            if idx not in rem_list:
-                temp_row.append(row[idx])
-        out_rows.append(",".join(map(str, temp_row)))
 
-    if distinct:
-        used = set()
-        unique = [x for x in out_rows if x not in used and (used.add(x) or True)]
-        out_rows = unique
+def get_conditions(plan, condition_ids):
+    """Returns conditions of plan with given ids"""
 
-    print(*out_rows, sep="\n")
+    return [plan["conditions"][condition_id] for condition_id in condition_ids]
 
 
-def add_column(token):
-    """Adds attribute to attribute list"""
+def estimate_distinct(values, rows):
+    """Returns estimated number of distinct values among rows rows from a sample of their values (Chao1 estimator)"""
 
-    global attribute_tokens
+    counts = Counter(values)
+    if not counts:
+        return 1
+    frequencies = Counter(counts.values())
+    singles, doubles = frequencies[1], frequencies[2]
+    unseen = singles * singles / (2 * doubles) if doubles else singles * (singles - 1) / 2
+    return max(1, min(rows, len(counts) + unseen))
 
-    if isinstance(token, sql.Identifier):
-        attribute_tokens.append(token)
-    if isinstance(token, sql.Function):
-        # (function, column)
-        attribute_tokens.append((token.tokens[0], token.tokens[1].tokens[1]))
 
+def estimate_table(table, conditions, logical_op, statistics=None):
+    """Returns (estimated rows, {attribute: estimated distinct values}) of table filtered by conditions"""
 
-def parser(query):
-    """Parses given SQL query"""
-
-    global distinct, wildcard_star, condition_tokens, table_tokens, logical_op
-
-    parsed = sqlparse.parse(query)[0]
-    from_seen = False
-
-    for token in parsed.tokens:
-        if token.ttype is T.Keyword and token.value.upper() == 'FROM': # FROM
-            from_seen = True
-
-        if from_seen:  # Tables List
-            if isinstance(token, sql.Identifier):
-                table_tokens.append(token)
-            if isinstance(token, sql.IdentifierList):
-                for identifier in token.get_identifiers():
-                    table_tokens.append(identifier)
-        else:  # attribute_tokens list
-            if isinstance(token, sql.IdentifierList):
-                for identifier in token.get_identifiers():
-                    add_column(identifier)
-            else:
-                if token.ttype is T.DML:
-                    continue
-                if token.ttype is T.Wildcard and token.value == "*":  # SELECT *
-                    wildcard_star = True
-                elif token.ttype is T.Keyword and token.value.upper() == "DISTINCT": # DISTINCT
-                    distinct = True
+    # From statistics if given, else from an evenly spaced sample of SAMPLE_SIZE rows
+    if statistics is not None:
+        selectivities = [estimate_selectivity(statistics, condition) for condition in conditions]
+        if logical_op == "OR":
+            selectivity = 1 - math.prod(1 - selectivity for selectivity in selectivities)
+        else:
+            selectivity = math.prod(selectivities)
+        rows = table["size"] * selectivity
+        return rows, {attr_name: max(1, min(statistics["columns"][attr_name]["distinct"], rows))
+                      for attr_name in table["attributes"] if attr_name in statistics["columns"]}
+
+    sample_ids = range(0, table["size"], max(1, table["size"] // SAMPLE_SIZE))
+    if not len(sample_ids):
+        return 0, {}
+    sample = apply_condition(gather(table, sample_ids), conditions, logical_op)
+
+    # A filter matching no sampled row still leaves about half a sample step of rows
+    rows = table["size"] * max(sample["size"], 0.5) / len(sample_ids)
+    return rows, {attr_name: estimate_distinct(column, rows) for attr_name, column in zip(sample["attributes"], sample["columns"])}
+
+
+def get_equi_join_pairs(plan):
+    """Returns [(attribute1, attribute2)] of the equality conditions between attributes of different tables"""
+
+    if plan["logical_op"] == "OR":
+        return []
+    return [(operand1, operand2) for operand1, op, operand2 in get_conditions(plan, plan["residual_conditions"])
+            if op == "=" and isinstance(operand1, str) and isinstance(operand2, str)]
+
+
+def get_join_order(engine, plan, loaded_tables):
+    """Returns (estimates, steps): (rows, {attribute: distinct}) per FROM position and the steps of the join order"""
+
+    # Steps are [(position, build on joined side, estimated rows)]; each table is tried first, then the table giving the smallest result joins next
+    tables = plan["tables"]
+    estimates = []
+    for position, table_name in enumerate(tables):
+        conditions = plan["pushed_conditions"].get(table_name, []) if table_name not in tables[:position] else []
+        estimates.append(estimate_table(loaded_tables[table_name], get_conditions(plan, conditions), plan["logical_op"], engine.get_statistics(table_name)))
+
+    # A table joined with itself repeats attribute names, which resolve by FROM order, so such joins keep it
+    reorder = len(set(tables)) == len(tables)
+    join_pairs = get_equi_join_pairs(plan) if reorder else []
+
+    def join_estimate(joined, distinct, size, position):
+        """Returns (not connected to joined positions by an equality, estimated rows) of joining table at position"""
+
+        rows, table_distinct = estimates[position]
+        selectivity, connected = 1.0, False
+        for attr_name1, attr_name2 in join_pairs:
+            for joined_attr, table_attr in ((attr_name1, attr_name2), (attr_name2, attr_name1)):
+                if tables.index(joined_attr.partition(".")[0]) in joined and tables.index(table_attr.partition(".")[0]) == position:
+                    selectivity /= max(distinct.get(joined_attr, 1), table_distinct.get(table_attr, 1))
+                    connected = True
+        return not connected, size * rows * selectivity
+
+    def greedy_order(first):
+        """Returns steps starting with table at position first, then joining next the table giving the smallest result"""
+
+        remaining = [position for position in range(len(tables)) if position != first]
+        joined, distinct, size = {first}, dict(estimates[first][1]), estimates[first][0]
+        steps = [(first, False, size)]
+        while remaining:
+            position = min(remaining, key=lambda position: join_estimate(joined, distinct, size, position)) if reorder else remaining[0]
+            remaining.remove(position)
+            joined_size = join_estimate(joined, distinct, size, position)[1]
+            steps.append((position, size < estimates[position][0], joined_size))
+
+            joined.add(position)
+            distinct.update(estimates[position][1])
+            distinct = {attr_name: min(count, max(joined_size, 1)) for attr_name, count in distinct.items()}
+            size = joined_size
+        return steps
+
+    # Every order gives the same final result, so orders are compared by their intermediate results, then, for equality joins, by the rows
+    # of their first table, so the more filtered side is joined first and its keys can filter the scan of the other; ties keep FROM order
+    orders = [greedy_order(first) for first in (range(len(tables)) if reorder else [0])]
+    return estimates, min(orders, key=lambda steps: (sum(rows for _, _, rows in steps[1:-1]), steps[0][2] if join_pairs else 0))
+
+
+def load_tables(engine, plan):
+    """Returns {table_name: table} of the tables of query plan, with only the attributes it uses"""
+
+    loaded_tables = {}
+    for table_name in plan["tables"]:
+        if table_name not in loaded_tables:
+            loaded_tables[table_name] = engine.get_table_data(table_name, plan["attributes"][table_name])
+    return loaded_tables
+
+
+def use_index_join(engine, table_name, table, joined_size, join_attributes):
+    """Returns (attribute, index) of table to probe with joined_size rows instead of hashing it, None if hashing is better"""
+
+    if joined_size * INDEX_SCAN_RATIO >= table["size"]:
+        return None
+    for attr_name in join_attributes:
+        index = engine.get_index(table_name, attr_name)
+        if index is not None:
+            return attr_name, index
+    return None
+
+
+def use_bloom_filter(engine, table_name, table, conditions, logical_op, joined_size, table_keys):
+    """Returns whether the scan of table should drop rows whose join key fails a Bloom filter of joined_size keys"""
+
+    # The filter is folded into the scan filtering table anyway, where each row costs BLOOM_FILTER_COST divided among the workers running
+    # in parallel, and saves copying and probing the dropped rows: about those whose key is not joined, less the false positives
+    if not conditions or index_lookup(engine, table_name, conditions, logical_op) is not None:
+        return False
+    workers = min(engine.workers, os.cpu_count() or 1) if table["size"] > PARTITION_SIZE else 1
+    passed = min(1.0, joined_size / max(1, table_keys)) + BLOOM_FALSE_POSITIVES
+    return BLOOM_FILTER_COST / workers < 1 - passed
+
+
+def filter_join_table(engine, table_name, table, conditions, logical_op, bloom=None):
+    """Returns rows of loaded table satisfying its pushed down conditions and (idx, Bloom filter) if given"""
+
+    if conditions_never_true(engine, table_name, conditions, logical_op):
+        return get_table(table["attributes"], [array('q') for _ in table["attributes"]], 0)
+    filtered_table = index_scan(engine, table, table_name, conditions, logical_op) if conditions else None
+    if filtered_table is not None:
+        return filtered_table if bloom is None else apply_bloom_filter(filtered_table, *bloom)
+
+    blocks = engine.get_zone_blocks(table_name, conditions, logical_op)
+    partitions = engine.get_partitions(table_name, table["attributes"], blocks)
+    if partitions is None and blocks is not None and blocks.count(0):
+        # Filter only the blocks whose zone map allows matching rows
+        table = concat_parts(table["attributes"], [get_table(table["attributes"], [column[start:stop] for column in table["columns"]], stop - start)
+                                                   for start, stop in get_zone_runs(blocks, table["size"], PARTITION_SIZE)])
+    return concat_parts(table["attributes"], filter_parts(engine, table, conditions, logical_op, range(len(table["attributes"])), partitions, bloom))
+
+
+def join_tables(engine, plan, idx_list):
+    """Yields parts of the joined rows of query plan satisfying all conditions, with the columns at idx_list in FROM order"""
+
+    # Tables are loaded only once the query is iterated, and only with the attributes it uses
+    loaded_tables = load_tables(engine, plan)
+    residual_conditions = get_conditions(plan, plan["residual_conditions"])
+
+    # Tables are filtered in the join order of get_join_order(), so the scan of a table joined to few rows can drop rows failing a Bloom filter of their keys.
+    # Joins only pair row ids; columns are gathered for join keys as needed and for the joined rows at the end, where the last join
+    # runs as the parts are taken, so it stops with them
+    estimates, steps = get_join_order(engine, plan, loaded_tables)
+    filtered_tables = [None] * len(plan["tables"])
+    row_ids = [None] * len(plan["tables"]) # row ids in every joined table of the joined rows, None for all rows of the first one
+    joined_sources = [] # (FROM position, column idx) of every joined column, in join order
+    joined_size = None
+    for step, (position, build_joined, _) in enumerate(steps):
+        table_name = plan["tables"][position]
+        loaded_table = loaded_tables[table_name]
+        conditions = []
+        if table_name not in plan["tables"][:position]:
+            # Filter only the first occurrence of a table, later ones are never referenced by the conditions
+            conditions = get_conditions(plan, plan["pushed_conditions"].get(table_name, []))
+        sources = [(position, idx) for idx in range(len(loaded_table["attributes"]))]
+        if joined_size is None:
+            filtered_tables[position] = filter_join_table(engine, table_name, loaded_table, conditions, plan["logical_op"]) if conditions else loaded_table
+            joined_size = filtered_tables[position]["size"]
+            joined_sources = sources
+            continue
+
+        joined_attributes = [filtered_tables[source]["attributes"][idx] for source, idx in joined_sources]
+        joined_table = get_table(joined_attributes, [], joined_size)
+        join_keys = get_join_keys(joined_table, loaded_table, residual_conditions, plan["logical_op"])
+        key_conditions = [condition for condition in residual_conditions if get_join_keys(joined_table, loaded_table, [condition], plan["logical_op"])]
+        key_table = get_table([joined_attributes[idx1] for idx1, _ in join_keys],
+                              gather_joined(filtered_tables, row_ids, [joined_sources[idx1] for idx1, _ in join_keys]), joined_size)
+        join_keys = [(key, idx2) for key, (_, idx2) in enumerate(join_keys)]
+        index = None
+        if join_keys and not conditions:
+            # Few probe rows against a whole table: look them up in an index of its join key instead of hashing it
+            index = use_index_join(engine, table_name, loaded_table, joined_size, [loaded_table["attributes"][idx2] for _, idx2 in join_keys])
+        if index is not None:
+            scanned_table = loaded_table
+            key = next(key for key, idx2 in join_keys if loaded_table["attributes"][idx2] == index[0])
+            pair_batches = index_join_batches(key_table, key, index[1])
+            key_conditions = key_conditions[key:key + 1] # the other equalities are still to be checked
+        else:
+            bloom = None
+            if join_keys and use_bloom_filter(engine, table_name, loaded_table, conditions, plan["logical_op"], joined_size,
+                                              estimates[position][1].get(loaded_table["attributes"][join_keys[0][1]], loaded_table["size"])):
+                bloom = join_keys[0][1], build_bloom_filter(key_table["columns"][0])
+            scanned_table = filter_join_table(engine, table_name, loaded_table, conditions, plan["logical_op"], bloom) if conditions else loaded_table
+            pair_batches = join_batches(key_table, scanned_table, join_keys, build_joined and joined_size < scanned_table["size"])
+        filtered_tables[position] = scanned_table
+        # Rows joined on equal keys satisfy the equality conditions the keys come from
+        residual_conditions = [condition for condition in residual_conditions if condition not in key_conditions]
+        joined_sources = joined_sources + sources
+        if step < len(steps) - 1:
+            row_ids = get_joined_row_ids(row_ids, position, steps[0][0], concat_row_ids(pair_batches))
+            joined_size = len(row_ids[position])
+
+    from_sources = sorted(joined_sources)
+    from_attributes = [filtered_tables[position]["attributes"][idx] for position, idx in from_sources]
+    for pairs in pair_batches:
+        batch_row_ids = get_joined_row_ids(row_ids, position, steps[0][0], pairs)
+        batch_size = len(pairs[0])
+        if residual_conditions:
+            # Filter on the condition columns only, keeping the numbers of the joined rows satisfying them
+            condition_idx = sorted({from_attributes.index(operand) for condition in residual_conditions for operand in condition[::2] if isinstance(operand, str)})
+            condition_table = get_table([from_attributes[idx] for idx in condition_idx] + [""],
+                                        gather_joined(filtered_tables, batch_row_ids, [from_sources[idx] for idx in condition_idx]) + [array('q', range(batch_size))], batch_size)
+            kept = concat_parts([""], filter_parts(engine, condition_table, residual_conditions, plan["logical_op"], [len(condition_idx)]))["columns"][0]
+            batch_row_ids = [array('q', map(ids.__getitem__, kept)) for ids in batch_row_ids]
+            batch_size = len(kept)
+        if batch_size:
+            yield get_table([from_attributes[idx] for idx in idx_list], gather_joined(filtered_tables, batch_row_ids, [from_sources[idx] for idx in idx_list]), batch_size)
+
+
+def get_joined_row_ids(row_ids, position, first_position, pairs):
+    """Returns row ids in every joined table once table at position is joined by given (row ids, row ids) pairs"""
+
+    row_ids_a, row_ids_b = pairs
+    joined_row_ids = list(row_ids)
+    for source, ids in enumerate(row_ids):
+        if source != position and (ids is not None or source == first_position):
+            joined_row_ids[source] = row_ids_a if ids is None else array('q', map(ids.__getitem__, row_ids_a))
+    joined_row_ids[position] = row_ids_b
+    return joined_row_ids
+
+
+def format_conditions(conditions, logical_op):
+    """Returns WHERE text of given conditions"""
+
+    return (" " + (logical_op or "AND") + " ").join(" ".join(map(str, condition)) for condition in conditions)
+
+
+def explain_filter(engine, table_name, conditions, logical_op):
+    """Returns text describing how conditions on table are evaluated"""
+
+    if not conditions:
+        return ""
+    line = " where " + format_conditions(conditions, logical_op)
+    if conditions_never_true(engine, table_name, conditions, logical_op):
+        return line + " skipped, never true by statistics"
+    if index_lookup(engine, table_name, conditions, logical_op) is not None:
+        return line + " using index"
+    zone_map = engine.get_zone_map(table_name)
+    blocks = None if zone_map is None else get_zone_blocks(zone_map, conditions, logical_op)
+    if blocks is not None and blocks.count(0):
+        line += ", zone maps skip " + str(blocks.count(0)) + " of " + str(len(blocks)) + " blocks"
+    return line
+
+
+def explain_output(engine, plan):
+    """Yields lines describing how query plan runs: scans, filters and joins with estimated rows, then operators"""
+
+    loaded_tables = load_tables(engine, plan)
+    if len(plan["tables"]) == 1:
+        table_name = plan["tables"][0]
+        conditions = get_conditions(plan, plan["pushed_conditions"].get(table_name, []) + plan["residual_conditions"])
+        yield "scan " + table_name + " (" + str(loaded_tables[table_name]["size"]) + " rows)" + explain_filter(engine, table_name, conditions, plan["logical_op"])
+    else:
+        estimates, steps = get_join_order(engine, plan, loaded_tables)
+        join_pairs = get_equi_join_pairs(plan)
+        joined_tables = []
+        joined_pairs = []
+        for position, build_joined, rows in steps:
+            table_name = plan["tables"][position]
+            pushed_conditions = plan["pushed_conditions"].get(table_name, []) if table_name not in plan["tables"][:position] else []
+            line = "scan " + table_name + " (" + str(loaded_tables[table_name]["size"]) + " rows)"
+            line += explain_filter(engine, table_name, get_conditions(plan, pushed_conditions), plan["logical_op"])
+            yield line + " -> ~" + str(round(estimates[position][0])) + " rows"
+
+            if joined_tables:
+                keys = [pair for pair in join_pairs if {attr_name.partition(".")[0] for attr_name in pair} <= set(joined_tables + [table_name])
+                        and table_name in {attr_name.partition(".")[0] for attr_name in pair}]
+                if not keys:
+                    line = "cross join " + table_name
                 else:
-                    add_column(token)
-
-
-        if isinstance(token, sql.Where):  # WHERE
-            comp_cnt = 0
-
-            for token_d1 in token.tokens:
-                if isinstance(token_d1, sql.Comparison):  # Condition
-                    comp_cnt += 1
-                    condition_tokens.append(token_d1)
-                if token_d1.ttype is T.Keyword and token_d1.value.upper() != "WHERE":
-                    if comp_cnt != 1:
-                        print("WhereError: Incorrect syntax with logical operator")
-                        exit(1)
-                    logical_op = token_d1.value.upper()
-            
-            if logical_op and comp_cnt < 2:
-                print("WhereError: Operand missing with logical operator")
-                exit(1)
-            if comp_cnt > 1 and logical_op is None:
-                print("WhereError: Logical operator missing and given multiple conditions")
-                exit(1)
-            if not condition_tokens:
-                print("WhereError: No conditions given")
-                exit(1)        
+                    line = "hash join " + table_name + " on " + " AND ".join(attr_name1 + " = " + attr_name2 for attr_name1, attr_name2 in keys)
+                    index = None
+                    if not pushed_conditions:
+                        index = use_index_join(engine, table_name, loaded_tables[table_name], steps[len(joined_tables) - 1][2],
+                                               [attr_name for pair in keys for attr_name in pair if attr_name.partition(".")[0] == table_name])
+                    if index is not None:
+                        keys = [next(pair for pair in keys if index[0] in pair)]
+                        line = "index join " + table_name + " on " + " AND ".join(attr_name1 + " = " + attr_name2 for attr_name1, attr_name2 in keys) + " using index " + index[0]
+                    else:
+                        line += ", build " + (" x ".join(joined_tables) if build_joined else table_name)
+                        key_attr = next(attr_name for pair in keys for attr_name in pair if attr_name.partition(".")[0] == table_name)
+                        if use_bloom_filter(engine, table_name, loaded_tables[table_name], get_conditions(plan, pushed_conditions), plan["logical_op"],
+                                            steps[len(joined_tables) - 1][2], estimates[position][1].get(key_attr, loaded_tables[table_name]["size"])):
+                            line += ", " + table_name + " scanned through bloom filter of joined keys"
+                    joined_pairs.extend(keys)
+                yield line + " -> ~" + str(round(rows)) + " rows"
+            joined_tables.append(table_name)
+
+        # Equality conditions used as join keys need no filter
+        residual_conditions = [(operand1, op, operand2) for operand1, op, operand2 in get_conditions(plan, plan["residual_conditions"])
+                               if op != "=" or (operand1, operand2) not in joined_pairs]
+        if residual_conditions:
+            yield "filter " + format_conditions(residual_conditions, plan["logical_op"])
+
+    if plan["aggregates"] or plan["group_by"]:
+        yield ("hash aggregate" + (" by " + ", ".join(plan["group_by"]) if plan["group_by"] else "")
+               + ": " + ", ".join(function + "(" + (attr_name or "*") + ")" for function, attr_name in plan["aggregates"]))
+    if plan["distinct"]:
+        yield "distinct"
+    if plan["order_by"]:
+        yield ("top " + str(plan["limit"]) + " " if plan["limit"] is not None else "") + "sort by " + ", ".join(
+            plan["header"][idx] + (" DESC" if descending else "") for idx, descending in plan["order_by"])
+    elif plan["limit"] is not None:
+        yield "limit " + str(plan["limit"])
+    yield "output " + ", ".join(plan["header"])
+
+
+def join_output(engine, plan):
+    """Yields projected rows of joined tables of query plan"""
+
+    for part in join_tables(engine, plan, plan["projection"]):
+        yield from get_rows(part, range(len(plan["projection"])))
+
+
+def stream_output(engine, plan):
+    """Scans, filters and projects the single table of query plan batch by batch, never holding the whole table"""
+
+    table_name = plan["tables"][0]
+    conditions = get_conditions(plan, plan["pushed_conditions"].get(table_name, []) + plan["residual_conditions"])
+    if conditions_never_true(engine, table_name, conditions, plan["logical_op"]):
+        return
+    row_ids = index_lookup(engine, table_name, conditions, plan["logical_op"]) if conditions else None
+    if row_ids is not None:
+        table = gather(engine.get_table_data(table_name, plan["attributes"][table_name]), row_ids)
+        yield from get_rows(apply_condition(table, conditions, plan["logical_op"]), plan["projection"])
+        return
+
+    blocks = engine.get_zone_blocks(table_name, conditions, plan["logical_op"])
+    partitions = engine.get_partitions(table_name, plan["attributes"][table_name], blocks) if conditions else None
+    if partitions is not None:
+        for part in engine.map_partitions(filter_partition, partitions, conditions, plan["logical_op"], plan["projection"]):
+            yield from get_rows(part, range(len(part["columns"])))
+        return
+
+    for batch in engine.scan_table(table_name, plan["attributes"][table_name], blocks):
+        yield from get_rows(apply_condition(batch, conditions, plan["logical_op"]), plan["projection"])
+
+
+def plan_query(context):
+    """Returns plan of parsed and validated query; it holds no syntax tree so it can be cached and run again"""
+
+    conditions, pushed_conditions, residual_conditions = plan_conditions(context)
+    referenced_attributes = get_referenced_attributes(context)
+    tables = list(context.table_names)
+
+    plan = {
+        "tables": tables,
+        "attributes": {table_name: get_table_attributes(context.tables[table_name]["attributes"], referenced_attributes[table_name]) for table_name in tables},
+        "conditions": conditions,
+        "pushed_conditions": pushed_conditions,
+        "residual_conditions": residual_conditions,
+        "logical_op": context.logical_op,
+        "distinct": context.distinct,
+        "group_by": [get_attribute_name(context, column) for column in context.group_by_nodes],
+        "aggregates": [],
+    }
+
+    if get_aggregates(context) or plan["group_by"]:
+        # Every attribute in SELECT is either a GROUP BY attribute or an aggregate
+        plan["header"], plan["output"] = [], []
+        for attribute in context.attribute_nodes:
+            if isinstance(attribute, Aggregate):
+                attr_name = None if attribute.column is None else get_attribute_name(context, attribute.column)
+                plan["header"].append(attribute.function + "(" + (attr_name or "*") + ")")
+                plan["output"].append(("aggregate", len(plan["aggregates"])))
+                plan["aggregates"].append((attribute.function.upper(), attr_name))
+            else:
+                attr_name = get_attribute_name(context, attribute)
+                plan["header"].append(attr_name)
+                plan["output"].append(("group", plan["group_by"].index(attr_name)))
+    else:
+        plan["header"], plan["projection"] = get_projection(context, [attr_name for table_name in tables for attr_name in plan["attributes"][table_name]])
+
+    plan["order_by"] = get_order_by(context, plan)
+    plan["limit"] = context.limit
+    plan["explain"] = context.explain
+    return plan
+
+
+def get_output_key(context, attribute):
+    """Returns attribute name, or (FUNCTION, attribute name) of aggregate, identifying attribute of SELECT or ORDER BY"""
+
+    if isinstance(attribute, Aggregate):
+        return attribute.function.upper(), None if attribute.column is None else get_attribute_name(context, attribute.column)
+    return get_attribute_name(context, attribute)
+
+
+def get_order_by(context, plan):
+    """Returns [(output column idx, descending)] of ORDER BY; its attributes must be output by the query"""
+
+    if plan["aggregates"] or plan["group_by"]:
+        output_keys = [get_output_key(context, attribute) for attribute in context.attribute_nodes]
+    else:
+        output_keys = plan["header"]
+
+    order_by = []
+    for attribute, descending in context.order_by_nodes:
+        output_key = get_output_key(context, attribute)
+        if output_key not in output_keys:
+            text = attribute.function + "(" + (attribute.column.value if attribute.column else "*") + ")" if isinstance(attribute, Aggregate) else attribute.value
+            raise QueryError("AttributeError: ORDER BY attribute " + text + " not in selected attributes")
+        order_by.append((output_keys.index(output_key), descending))
+    return order_by
+
+
+def get_plan_constants(plan):
+    """Returns constants of the conditions and LIMIT of plan, in query order"""
+
+    constants = [operand for operand1, _, operand2 in plan["conditions"] for operand in (operand1, operand2) if not isinstance(operand, str)]
+    return constants if plan["limit"] is None else constants + [plan["limit"]]
+
+
+def bind_plan(plan, literals):
+    """Returns copy of plan with the constants of its conditions and LIMIT replaced, in query order, by given literals"""
+
+    literals = iter(literals)
+    conditions = []
+    for operand1, op, operand2 in plan["conditions"]:
+        if not isinstance(operand1, str):
+            operand1 = next(literals)
+        if not isinstance(operand2, str):
+            operand2 = next(literals)
+        conditions.append((operand1, op, operand2))
+
+    bound_plan = dict(plan)
+    bound_plan["conditions"] = conditions
+    if plan["limit"] is not None:
+        bound_plan["limit"] = next(literals)
+        if not 0 <= bound_plan["limit"] <= sys.maxsize:
+            # The parser rejects a LIMIT out of range, but a query sharing the shape of a cached one is not parsed again
+            raise QueryError("SyntaxError: Unexpected " + str(bound_plan["limit"]) + " in query\n" + STANDARD_QUERY)
+    return bound_plan
+
+
+def normalize_query(query):
+    """Returns (query with whitespace collapsed, its shape with integer literals replaced by ?, the literals)"""
+
+    query = " ".join(query.split())
+    return query, LITERAL_PATTERN.sub("?", query), [int(literal) for literal in LITERAL_PATTERN.findall(query)]
+
+
+def execute_plan(engine, plan):
+    """Runs given query plan, returning its QueryResult"""
+
+    if plan["explain"]:
+        return QueryResult(["plan"], ((line,) for line in explain_output(engine, plan)))
+
+    if plan["aggregates"] or plan["group_by"]:
+        rows = aggregate_output(engine, plan)
+    else:
+        rows = stream_output(engine, plan) if len(plan["tables"]) == 1 else join_output(engine, plan)
+    if plan["distinct"]:
+        rows = distinct_rows(rows, engine.distinct_limit)
+
+    if plan["order_by"]:
+        rows = order_rows(rows, plan["order_by"], plan["limit"], engine.sort_limit)
+    elif plan["limit"] is not None:
+        # Rows are computed lazily, so the scan or join stops once limit rows are taken
+        rows = islice(rows, plan["limit"])
+    return QueryResult(plan["header"], rows)
+
+
+def print_result(result, output=None):
+    """Prints header and rows of given QueryResult as csv lines to output (stdout by default)"""
+
+    output = output or sys.stdout
+    print(",".join(result.attributes), file=output)
+
+    printed = 0
+    while True:
+        out_rows = [",".join(map(str, row)) if None not in row else ",".join("NULL" if value is None else str(value) for value in row)
+                    for row in islice(result, BATCH_SIZE)]
+        if not out_rows:
+            break
+        print(*out_rows, sep="\n", file=output)
+        printed += len(out_rows)
+    if not printed:
+        print(file=output)
+
+
+def tokenize(query):
+    """Returns [(kind, text)] tokens of given query, kind being number, name, keyword, op or the symbol itself"""
+
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(query.rstrip()):
+        kind, text = match.lastgroup, match.group(match.lastgroup)
+        if kind == "other":
+            raise QueryError("SyntaxError: Unexpected character " + text + "\n" + STANDARD_QUERY)
+        if kind == "name" and text.upper() in KEYWORDS:
+            kind, text = "keyword", text.upper()
+        elif kind == "symbol":
+            kind = text
+        tokens.append((kind, text))
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser of [EXPLAIN] SELECT [DISTINCT] attributes|* FROM tables [WHERE condition [AND|OR condition]]
+    [GROUP BY attributes] [ORDER BY attributes [ASC|DESC]] [LIMIT n];"""
+
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    def peek(self):
+        """Returns kind of next token, None at end of query"""
+
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def at_keyword(self, *keywords):
+        """Returns whether next token is one of given keywords"""
+
+        return self.peek() == "keyword" and self.tokens[self.pos][1] in keywords
+
+    def advance(self):
+        """Consumes and returns text of next token"""
+
+        text = self.tokens[self.pos][1]
+        self.pos += 1
+        return text
+
+    def expect(self, kind):
+        """Consumes and returns text of next token, which must be of given kind"""
+
+        if self.peek() != kind:
+            self.error()
+        return self.advance()
+
+    def accept_keywords(self, *keywords):
+        """Consumes given sequence of keywords if next token is the first of them, returning whether it did"""
+
+        if not self.at_keyword(keywords[0]):
+            return False
+        for keyword in keywords:
+            if not self.at_keyword(keyword):
+                self.error()
+            self.advance()
+        return True
+
+    def error(self):
+        """Raises SyntaxError for next token"""
+
+        if self.pos < len(self.tokens):
+            raise QueryError("SyntaxError: Unexpected " + self.tokens[self.pos][1] + " in query\n" + STANDARD_QUERY)
+        raise QueryError("SyntaxError: Unexpected end of query\n" + STANDARD_QUERY)
+
+    def parse(self):
+        """Returns syntax tree of the query, a dict of its clauses"""
+
+        syntax_tree = {"attributes": [], "tables": [], "conditions": [], "logical_op": None, "group_by": [], "order_by": [], "limit": None,
+                       "distinct": False, "wildcard_star": None, "explain": self.accept_keywords("EXPLAIN")}
+
+        if not self.at_keyword("SELECT"):
+            self.error()
+        self.advance()
+        if self.at_keyword("DISTINCT"):
+            self.advance()
+            syntax_tree["distinct"] = True
+
+        if self.peek() == "*":  # SELECT *
+            self.advance()
+            syntax_tree["wildcard_star"] = True
+        elif not self.at_keyword("FROM"):
+            syntax_tree["attributes"] = self.parse_list(self.parse_attribute)
+
+        if not self.at_keyword("FROM"):
+            self.error()
+        self.advance()
+        if self.peek() == "name":
+            syntax_tree["tables"] = self.parse_list(lambda: self.expect("name"))
+
+        if self.at_keyword("WHERE"):
+            self.advance()
+            self.parse_where(syntax_tree)
+
+        if self.accept_keywords("GROUP", "BY"):
+            syntax_tree["group_by"] = self.parse_list(self.parse_column)
+        if self.accept_keywords("ORDER", "BY"):
+            syntax_tree["order_by"] = self.parse_list(self.parse_order_item)
+        if self.accept_keywords("LIMIT"):
+            if self.peek() != "number" or not 0 <= int(self.tokens[self.pos][1]) <= sys.maxsize:
+                self.error()
+            syntax_tree["limit"] = int(self.advance())
+
+        self.expect(";")
+        if self.peek() is not None:
+            self.error()
+        return syntax_tree
+
+    def parse_list(self, parse_item):
+        """Returns items parsed by parse_item separated by commas"""
+
+        items = [parse_item()]
+        while self.peek() == ",":
+            self.advance()
+            items.append(parse_item())
+        return items
+
+    def parse_attribute(self):
+        """Returns Column or Aggregate"""
+
+        if self.peek() == "name" and self.pos + 1 < len(self.tokens) and self.tokens[self.pos + 1][0] == "(":
+            function = self.advance()
+            self.advance()
+            if self.peek() == "*":
+                self.advance()
+                column = None
+            else:
+                column = self.parse_column()
+            self.expect(")")
+            return Aggregate(function, column)
+        return self.parse_column()
+
+    def parse_order_item(self):
+        """Returns (Column or Aggregate, descending) of ORDER BY"""
+
+        attribute = self.parse_attribute()
+        if self.at_keyword("ASC", "DESC"):
+            return attribute, self.advance() == "DESC"
+        return attribute, False
+
+    def parse_column(self):
+        """Returns Column [table.]name"""
+
+        name = self.expect("name")
+        if self.peek() == ".":
+            self.advance()
+            return Column(name, self.expect("name"))
+        return Column(None, name)
+
+    def parse_operand(self):
+        """Returns Column or int operand of condition, None if next token is neither"""
+
+        if self.peek() == "number":
+            return int(self.advance())
+        if self.peek() == "name":
+            return self.parse_column()
+        return None
+
+    def parse_condition(self):
+        """Returns Condition, None if next tokens are not one"""
+
+        start = self.pos
+        operand1 = self.parse_operand()
+        if operand1 is not None and self.peek() == "op":
+            op = self.advance()
+            operand2 = self.parse_operand()
+            if operand2 is not None:
+                return Condition(operand1, op, operand2)
+        self.pos = start
+        return None
+
+    def parse_where(self, syntax_tree):
+        """Parses conditions of WHERE clause joined by at most one logical operator"""
+
+        conditions = syntax_tree["conditions"]
+        while self.peek() not in (";", None):
+            if self.at_keyword("AND", "OR"):
+                if len(conditions) != 1:
+                    raise QueryError("WhereError: Incorrect syntax with logical operator")
+                syntax_tree["logical_op"] = self.advance()
+                continue
+
+            condition = self.parse_condition()
+            if condition is None:
+                break
+            if len(conditions) == 1 and syntax_tree["logical_op"] is None:
+                raise QueryError("WhereError: Logical operator missing and given multiple conditions")
+            conditions.append(condition)
+
+        if syntax_tree["logical_op"] and len(conditions) < 2:
+            raise QueryError("WhereError: Operand missing with logical operator")
+        if not conditions:
+            raise QueryError("WhereError: No conditions given")
+
+
+def parser(query):
+    """Parses given SQL query, returning its syntax tree"""
+
+    return Parser(query).parse()
 
 
 def get_tables_metadata(metadata_path):
-    """Fetches and stores table schema from metadata file"""
+    """Returns {table_name: {"attributes": schema, "indexes": indexed attributes}} read from metadata file"""
 
-    global TABLES
+    # A table lists "<index> attribute" lines among its attributes
+    tables = defaultdict(dict)
 
     try:
         with open(metadata_path) as metadata_file:
             metadata_file = list(map(str.strip, metadata_file.readlines()))
+    except Exception as e:
+        raise QueryError("MetadataReadingError: " + str(e))
 
-        try:
-            for i in range(len(metadata_file)):
-                if metadata_file[i] == "<begin_table>":
-                    i += 1
-                    table_name = metadata_file[i]
-                    TABLES[table_name] = defaultdict(dict)
-                    TABLES[table_name]["attributes"] = []
+    try:
+        for i in range(len(metadata_file)):
+            if metadata_file[i] == "<begin_table>":
+                i += 1
+                table_name = metadata_file[i]
+                tables[table_name] = defaultdict(dict)
+                tables[table_name]["attributes"] = []
+                tables[table_name]["indexes"] = []
+                i += 1
+                while metadata_file[i] != "<end_table>":
+                    if metadata_file[i].startswith("<index>"):
+                        tables[table_name]["indexes"].append(table_name + "." + metadata_file[i][len("<index>"):].strip())
+                    else:
+                        tables[table_name]["attributes"].append(table_name + "." + metadata_file[i])
                     i += 1
-                    while metadata_file[i] != "<end_table>":
-                        TABLES[table_name]["attributes"].append(table_name + "." + metadata_file[i])
-                        i += 1
-        except Exception as e:
-            print("MetadataInputError: " + str(e))
-
     except Exception as e:
-        print("MetadataReadingError: " + str(e))
-        
+        raise QueryError("MetadataInputError: " + str(e))
+
+    return tables
+
+
+def get_table_attributes(schema, attributes=None):
+    """Returns given attributes (all by default) of table schema in schema order"""
+
+    if attributes is None:
+        return list(schema)
+    return [attr_name for attr_name in schema if attr_name in attributes]
+
+
+def read_csv_batches(files_dir, table_name, schema, attributes):
+    """Yields batches of BATCH_SIZE rows parsed from csv file of table, keeping only given attributes"""
+
+    idx_list = [schema.index(attr_name) for attr_name in attributes]
+
+    with open(files_dir + "/" + table_name + ".csv") as table_file:
+        while True:
+            lines = list(islice(table_file, BATCH_SIZE))
+            if not lines:
+                break
+
+            rows = [line.strip().split(",") for line in lines]
+            if any(len(row) != len(schema) for row in rows):
+                raise QueryError("Inconsistency between metadata file and " + table_name + ".csv", exit_code=0)
+
+            columns = [array('q', [int(row[idx]) for row in rows]) for idx in idx_list]
+            yield get_table(attributes, columns, len(rows))
+
+
+def get_cache_path(files_dir, table_name):
+    """Returns path of binary column cache of table"""
+
+    return files_dir + "/" + table_name + ".cache"
+
 
-def get_table_data(files_dir, table_name):
-    """Fetches and stores table data from csv file given path and filename"""
+def get_cache_key(files_dir, table_name, schema):
+    """Returns (csv size, csv mtime, schema bytes) a cache of table must match to be valid"""
 
-    global TABLES
+    csv_stat = os.stat(files_dir + "/" + table_name + ".csv")
+    schema = ",".join(schema).encode()
+    return csv_stat.st_size, csv_stat.st_mtime_ns, schema + b"\0" * (-len(schema) % 8)
 
+
+def build_zone_map(table):
+    """Returns {attribute: (minimums, maximums)} of columns of table over its blocks of ZONE_SIZE rows"""
+
+    zone_map = {}
+    for attr_name, column in zip(table["attributes"], table["columns"]):
+        blocks = [column[start:start + ZONE_SIZE] for start in range(0, table["size"], ZONE_SIZE)]
+        zone_map[attr_name] = array('q', map(min, blocks)), array('q', map(max, blocks))
+    return zone_map
+
+
+def build_table_cache(files_dir, table_name, schema):
+    """Parses csv file of table once and writes its columns, then their zone maps, to the binary column cache"""
+
+    csv_size, csv_mtime, schema_bytes = get_cache_key(files_dir, table_name, schema)
+    temp_fd, temp_path = tempfile.mkstemp(dir=files_dir, prefix=table_name + ".", suffix=".tmp")
+
+    column_files = []
+    zone_map = {attr_name: (array('q'), array('q')) for attr_name in schema}
     try:
-        with open(files_dir + "/" + table_name + ".csv") as table_file:
-            table_file = list(map(str.strip, table_file.readlines()))
-        
-        TABLES[table_name]["rows"] = []
-        for line in table_file:
-            line = list(map(int, line.split(",")))
-
-            if len(line) != len(TABLES[table_name]["attributes"]):
-                print("Inconsistency between metadata file and", table_name + ".csv")
-                exit(0)
-            else:
-                TABLES[table_name]["rows"].append(line)
+        # The cache file is opened first so its descriptor is closed even if the csv file cannot be parsed
+        with open(temp_fd, "wb") as cache_file:
+            column_files = [tempfile.TemporaryFile(dir=files_dir) for _ in schema]
+            rows = 0
+            for batch in read_csv_batches(files_dir, table_name, schema, schema):
+                for column, column_file in zip(batch["columns"], column_files):
+                    column.tofile(column_file)
+                for attr_name, (minimums, maximums) in build_zone_map(batch).items():
+                    zone_map[attr_name][0].extend(minimums)
+                    zone_map[attr_name][1].extend(maximums)
+                rows += batch["size"]
+
+            cache_file.write(CACHE_HEADER.pack(CACHE_MAGIC, csv_size, csv_mtime, rows, len(schema_bytes)))
+            cache_file.write(schema_bytes)
+            for column_file in column_files:
+                column_file.seek(0)
+                while True:
+                    chunk = column_file.read(BATCH_SIZE * 8)
+                    if not chunk:
+                        break
+                    cache_file.write(chunk)
+            for attr_name in schema:
+                zone_map[attr_name][0].tofile(cache_file)
+                zone_map[attr_name][1].tofile(cache_file)
+        os.replace(temp_path, get_cache_path(files_dir, table_name))
+    finally:
+        for column_file in column_files:
+            column_file.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def read_cache_header(files_dir, table_name, schema):
+    """Returns (cache_view, rows, data_offset) of the mapped column cache of table, None if stale or of another schema"""
+
+    csv_size, csv_mtime, schema_bytes = get_cache_key(files_dir, table_name, schema)
+    try:
+        cache_file = open(get_cache_path(files_dir, table_name), "rb")
+    except FileNotFoundError:
+        return None
+
+    with cache_file:
+        header = cache_file.read(CACHE_HEADER.size)
+        if len(header) == CACHE_HEADER.size:
+            magic, cached_size, cached_mtime, rows, schema_len = CACHE_HEADER.unpack(header)
+            if (magic, cached_size, cached_mtime, schema_len) == (CACHE_MAGIC, csv_size, csv_mtime, len(schema_bytes)) and cache_file.read(schema_len) == schema_bytes:
+                # Pages are shared with every other process mapping the same cache
+                cache_view = memoryview(mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ))
+                return cache_view, rows, CACHE_HEADER.size + schema_len
+    return None
+
+
+def open_table_cache(files_dir, table_name, schema):
+    """Returns (cache_view, rows, data_offset) of column cache of table, rebuilt if stale; None if it cannot be used"""
+
+    try:
+        cache = read_cache_header(files_dir, table_name, schema)
+        if cache is None:
+            build_table_cache(files_dir, table_name, schema)
+            cache = read_cache_header(files_dir, table_name, schema)
+        return cache
+    except OSError:
+        return None
+
+
+def read_cache_columns(cache, schema, attributes, start, stop):
+    """Returns given attributes of rows [start, stop) of table as zero-copy int64 views of its binary column cache"""
+
+    cache_view, rows, data_offset = cache
+    itemsize = array('q').itemsize
+
+    columns = []
+    for attr_name in attributes:
+        column_offset = data_offset + schema.index(attr_name) * rows * itemsize
+        columns.append(cache_view[column_offset + start * itemsize:column_offset + stop * itemsize].cast('q'))
+    return get_table(attributes, columns, stop - start)
+
+
+def read_cache_zones(cache, schema):
+    """Returns {attribute: (minimums, maximums)} zone map of table as zero-copy int64 views of its binary column cache"""
+
+    cache_view, rows, data_offset = cache
+    blocks = -(-rows // ZONE_SIZE)
+    zones = cache_view[data_offset + len(schema) * rows * array('q').itemsize:].cast('q')
+    return {attr_name: (zones[2 * idx * blocks:(2 * idx + 1) * blocks], zones[(2 * idx + 1) * blocks:(2 * idx + 2) * blocks])
+            for idx, attr_name in enumerate(schema)}
+
+
+def scan_table_files(files_dir, table_name, schema, attributes, blocks=None):
+    """Yields given attributes of table in batches of BATCH_SIZE rows, from its column cache or else its csv file"""
 
+    # Only blocks selected by blocks are read from the cache
+    try:
+        cache = open_table_cache(files_dir, table_name, schema)
+        if cache is None:
+            yield from read_csv_batches(files_dir, table_name, schema, attributes)
+        else:
+            for start, stop in get_zone_runs(blocks, cache[1], BATCH_SIZE):
+                yield read_cache_columns(cache, schema, attributes, start, stop)
+    except QueryError:
+        raise
     except Exception as e:
-        print("TabledataReadingError: " + str(e))
+        raise QueryError("TabledataReadingError: " + str(e))
+
+
+def read_table_data(files_dir, table_name, schema, attributes):
+    """Reads given attributes of table from its binary column cache, or its csv file if no cache can be used"""
+
+    columns = [array('q') for _ in attributes]
+    size = 0
+
+    try:
+        cache = open_table_cache(files_dir, table_name, schema)
+        if cache is not None:
+            return read_cache_columns(cache, schema, attributes, 0, cache[1])
+
+        for batch in read_csv_batches(files_dir, table_name, schema, attributes):
+            for column, batch_column in zip(columns, batch["columns"]):
+                column.extend(batch_column)
+            size += batch["size"]
+    except QueryError:
+        raise
+    except Exception as e:
+        raise QueryError("TabledataReadingError: " + str(e))
+
+    return get_table(attributes, columns, size)
+
+
+def get_index_path(files_dir, attr_name):
+    """Returns path of sorted index of table attribute table.attribute"""
+
+    return files_dir + "/" + attr_name + ".index"
+
+
+def build_table_index(files_dir, table_name, schema, attr_name):
+    """Writes sorted index of attribute of table: its values in ascending order, then the row ids holding them"""
+
+    csv_size, csv_mtime, _ = get_cache_key(files_dir, table_name, schema)
+    column = read_table_data(files_dir, table_name, schema, [attr_name])["columns"][0]
+    row_ids = array('q', sorted(range(len(column)), key=column.__getitem__))
+    values = array('q', map(column.__getitem__, row_ids))
+
+    temp_fd, temp_path = tempfile.mkstemp(dir=files_dir, prefix=attr_name + ".", suffix=".tmp")
+    try:
+        with open(temp_fd, "wb") as index_file:
+            index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, csv_size, csv_mtime, len(values)))
+            values.tofile(index_file)
+            row_ids.tofile(index_file)
+        os.replace(temp_path, get_index_path(files_dir, attr_name))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def read_table_index(files_dir, table_name, schema, attr_name):
+    """Returns (values, row_ids) views of mapped index of attribute of table, None if its csv file changed"""
+
+    csv_size, csv_mtime, _ = get_cache_key(files_dir, table_name, schema)
+    try:
+        index_file = open(get_index_path(files_dir, attr_name), "rb")
+    except FileNotFoundError:
+        return None
+
+    with index_file:
+        header = index_file.read(INDEX_HEADER.size)
+        if len(header) == INDEX_HEADER.size:
+            magic, indexed_size, indexed_mtime, rows = INDEX_HEADER.unpack(header)
+            if (magic, indexed_size, indexed_mtime) == (INDEX_MAGIC, csv_size, csv_mtime):
+                index_view = memoryview(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))[INDEX_HEADER.size:].cast('q')
+                return index_view[:rows], index_view[rows:]
+    return None
+
+
+def open_table_index(files_dir, table_name, schema, attr_name):
+    """Returns (values, row_ids) of index of attribute of table, rebuilt if missing or stale"""
+
+    index = read_table_index(files_dir, table_name, schema, attr_name)
+    if index is None:
+        build_table_index(files_dir, table_name, schema, attr_name)
+        index = read_table_index(files_dir, table_name, schema, attr_name)
+    return index
+
+
+def hash64(value):
+    """Returns 64 bit hash of integer value, well mixed unlike hash() (splitmix64 finalizer)"""
+
+    value = (value + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return value ^ (value >> 31)
+
+
+def add_to_sketch(registers, values):
+    """Adds values to HyperLogLog sketch registers"""
+
+    rank_bits = 64 - HLL_BITS
+    rank_mask = (1 << rank_bits) - 1
+    for value in values:
+        hashed = hash64(value)
+        rank = rank_bits - (hashed & rank_mask).bit_length() + 1
+        if rank > registers[hashed >> rank_bits]:
+            registers[hashed >> rank_bits] = rank
+
+
+def count_sketch(registers):
+    """Returns number of distinct values estimated by HyperLogLog sketch registers"""
+
+    size = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * size and zeros:
+        estimate = size * math.log(size / zeros) # few values: linear counting is more accurate
+    return max(1, round(estimate))
+
+
+def analyze_table(batches, attributes):
+    """Returns statistics {"rows", "columns": {attribute: {"min", "max", "distinct", "histogram"}}} of batches"""
+
+    rows = 0
+    columns = {attr_name: {"min": None, "max": None} for attr_name in attributes}
+    sketches = {attr_name: bytearray(1 << HLL_BITS) for attr_name in attributes}
+    samples = {attr_name: [] for attr_name in attributes}
+    step = 1 # samples hold the values of every step-th row
+
+    for batch in batches:
+        if not batch["size"]:
+            continue
+        for attr_name, column in zip(attributes, batch["columns"]):
+            statistics = columns[attr_name]
+            statistics["min"] = min(column) if statistics["min"] is None else min(statistics["min"], min(column))
+            statistics["max"] = max(column) if statistics["max"] is None else max(statistics["max"], max(column))
+            add_to_sketch(sketches[attr_name], set(column))
+            samples[attr_name].extend(column[-rows % step::step])
+        rows += batch["size"]
+
+        if attributes and len(samples[attributes[0]]) > 2 * HISTOGRAM_SAMPLE:
+            samples = {attr_name: sample[::2] for attr_name, sample in samples.items()}
+            step *= 2
+
+    for attr_name in attributes:
+        if not rows:
+            del columns[attr_name]
+            continue
+        sample = sorted(samples[attr_name])
+        columns[attr_name]["distinct"] = min(rows, count_sketch(sketches[attr_name]))
+        columns[attr_name]["histogram"] = [sample[bucket * (len(sample) - 1) // HISTOGRAM_BUCKETS] for bucket in range(HISTOGRAM_BUCKETS + 1)]
+    return {"rows": rows, "columns": columns}
+
+
+def read_statistics(statistics_path):
+    """Returns {table_name: statistics} read from statistics file, empty if it is missing or unreadable"""
+
+    # Statistics are only hints, so a missing or broken file is ignored
+    try:
+        with open(statistics_path) as statistics_file:
+            statistics = json.load(statistics_file)
+    except (OSError, ValueError):
+        return {}
+    return statistics if isinstance(statistics, dict) else {}
 
 
-def check_attribute(attribute):
+def write_statistics(statistics_path, statistics):
+    """Replaces statistics file with given {table_name: statistics}"""
+
+    temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(statistics_path) or ".", prefix=STATISTICS_FILE + ".", suffix=".tmp")
+    try:
+        with open(temp_fd, "w") as statistics_file:
+            json.dump(statistics, statistics_file)
+        os.replace(temp_path, statistics_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_histogram_fraction(histogram, value):
+    """Returns estimated fraction of values not above value from equi-depth histogram bounds"""
+
+    if value < histogram[0]:
+        return 0.0
+    if value >= histogram[-1]:
+        return 1.0
+    bucket = bisect_right(histogram, value) - 1
+    low, high = histogram[bucket], histogram[bucket + 1]
+    return (bucket + ((value - low) / (high - low) if high > low else 1.0)) / (len(histogram) - 1)
+
+
+def get_constant_comparison(condition):
+    """Returns (attribute, op, constant) of condition comparing an attribute with a constant, None for other conditions"""
+
+    operand1, op, operand2 = condition
+    if isinstance(operand1, str) == isinstance(operand2, str):
+        return None
+    if isinstance(operand1, str):
+        return operand1, op, operand2
+    return (operand2, flipped_ops[op], operand1) if op in flipped_ops else (operand2, op, operand1)
+
+
+def range_never_true(op, value, low, high):
+    """Returns whether no v in [low, high] satisfies v op value"""
+
+    if op == "=":
+        return not low <= value <= high
+    if op == "!=":
+        return low == high == value
+    if op == "<":
+        return value <= low
+    if op == "<=":
+        return value < low
+    if op == ">":
+        return value >= high
+    return value > high
+
+
+def condition_never_true(statistics, condition):
+    """Returns whether min and max of table statistics show no row satisfies condition"""
+
+    comparison = get_constant_comparison(condition)
+    if comparison is None or comparison[0] not in statistics["columns"]:
+        return False
+    attr_name, op, value = comparison
+    return range_never_true(op, value, statistics["columns"][attr_name]["min"], statistics["columns"][attr_name]["max"])
+
+
+def get_zone_blocks(zone_map, conditions, logical_op):
+    """Returns bytes of 1 for blocks of zone map that may hold rows satisfying conditions, else 0; None if it tells nothing"""
+
+    masks = []
+    for condition in conditions:
+        comparison = get_constant_comparison(condition)
+        if comparison is None or comparison[0] not in zone_map:
+            masks.append(None) # any block may satisfy it
+            continue
+        attr_name, op, value = comparison
+        masks.append([not range_never_true(op, value, low, high) for low, high in zip(*zone_map[attr_name])])
+
+    if logical_op == "OR":
+        masks = None if None in masks else masks
+    else:
+        masks = [mask for mask in masks if mask is not None]
+    if not masks:
+        return None
+    return bytes(map(any if logical_op == "OR" else all, zip(*masks)))
+
+
+def get_zone_runs(blocks, rows, run_size):
+    """Yields [start, stop) ranges of at most run_size rows, a multiple of ZONE_SIZE, covering blocks (all if None)"""
+
+    if blocks is None or len(blocks) != -(-rows // ZONE_SIZE):
+        blocks = repeat(1, -(-rows // ZONE_SIZE))
+
+    start = stop = None
+    for block, selected in enumerate(blocks):
+        if not selected:
+            continue
+        block_start = block * ZONE_SIZE
+        if start is not None and block_start == stop and block_start + ZONE_SIZE - start <= run_size:
+            stop = min(block_start + ZONE_SIZE, rows)
+            continue
+        if start is not None:
+            yield start, stop
+        start, stop = block_start, min(block_start + ZONE_SIZE, rows)
+    if start is not None:
+        yield start, stop
+
+
+def estimate_selectivity(statistics, condition):
+    """Returns estimated fraction of rows of table satisfying condition from its statistics"""
+
+    comparison = get_constant_comparison(condition)
+    if comparison is None:
+        operand1, op, operand2 = condition
+        return DEFAULT_SELECTIVITY if isinstance(operand1, str) else float(relational_ops[op](operand1, operand2))
+    if comparison[0] not in statistics["columns"]:
+        return DEFAULT_SELECTIVITY
+    if condition_never_true(statistics, condition):
+        return 0.0
+
+    attr_name, op, value = comparison
+    column = statistics["columns"][attr_name]
+    if op == "=":
+        return 1 / column["distinct"]
+    if op == "!=":
+        return 1 - 1 / column["distinct"]
+    below = get_histogram_fraction(column["histogram"], value)
+    return below if op in ("<", "<=") else 1 - below
+
+
+def get_referenced_attributes(context):
+    """Returns {table_name: set of attributes} needed by the projection, aggregates, GROUP BY and WHERE conditions"""
+
+    referenced = defaultdict(set)
+    attr_names = []
+    if context.wildcard_star:
+        for table in context.table_names:
+            attr_names.extend(context.tables[table]["attributes"])
+    for attribute in context.attribute_nodes:
+        column = attribute.column if isinstance(attribute, Aggregate) else attribute
+        if column is not None:
+            attr_names.append(get_attribute_name(context, column))
+    for column in context.group_by_nodes:
+        attr_names.append(get_attribute_name(context, column))
+    for condition_node in context.condition_nodes:
+        operand1, _, operand2 = get_condition(context, condition_node)
+        attr_names.extend(operand for operand in (operand1, operand2) if isinstance(operand, str))
+
+    for attr_name in attr_names:
+        referenced[attr_name[:attr_name.index(".")]].add(attr_name)
+    return referenced
+
+
+def check_attribute(context, attribute):
     """Handles attribute errors"""
 
-    global aggregate_ops, table_tokens
-
-    if type(attribute) == tuple:
-        if attribute[0].value.upper() not in aggregate_ops.keys():
-            print("FunctionError:", attribute[0].value + "()", "is invalid")
-            exit(1)
-        attribute = attribute[1]
-    if attribute.get_parent_name() is None:
-        if get_column_table(attribute) is None:
-            print("AttributeError: Attribute", attribute.value, "does not exist in given table(s)")
-            exit(1)
+    if isinstance(attribute, Aggregate):
+        if attribute.function.upper() not in aggregate_ops.keys():
+            raise QueryError("FunctionError: " + attribute.function + "() is invalid")
+        if attribute.column is None:
+            if attribute.function.upper() != "COUNT":
+                raise QueryError("FunctionError: " + attribute.function + "(*) is invalid, only count(*) is supported")
+            return
+        attribute = attribute.column
+    if attribute.table is None:
+        if get_column_table(context, attribute) is None:
+            raise QueryError("AttributeError: Attribute " + attribute.value + " does not exist in given table(s)")
     else:
-        if attribute.get_parent_name() not in [t.value for t in table_tokens]:
-            print("TableError:", attribute.get_parent_name(), "in", attribute.value, "not in given table list")
-            exit(1)
+        if attribute.table not in context.table_names:
+            raise QueryError("TableError: " + attribute.table + " in " + attribute.value + " not in given table list")
 
 
-def check_misc_errors():
+def check_misc_errors(context):
     """Checks unclassified errors"""
 
-    global attribute_tokens, wildcard_star, logical_op, condition_tokens, table_tokens
-
-    if not attribute_tokens and not wildcard_star:
-        print("SyntaxError: No attributes given")
-        print("Standard Query: select * from table_name where condition;")
-        exit(1)
-    if not table_tokens:
-        print("SyntaxError: No tables given")
-        print("Standard Query: select * from table_name where condition;")
-        exit(1)
-    if logical_op and not condition_tokens:
-        print("SyntaxError: No condition given")
-        print("Standard Query: select * from table_name where condition;")
-        exit(1)
+    if not context.attribute_nodes and not context.wildcard_star:
+        raise QueryError("SyntaxError: No attributes given\n" + STANDARD_QUERY)
+    if not context.table_names:
+        raise QueryError("SyntaxError: No tables given\n" + STANDARD_QUERY)
+    for table in context.table_names:
+        if table not in context.tables:
+            raise QueryError("TableError: Table " + table + " does not exist")
+    if context.logical_op and not context.condition_nodes:
+        raise QueryError("SyntaxError: No condition given\n" + STANDARD_QUERY)
 
 
     # Attribute Checking
     agg_cnt = 0
-    for attribute in attribute_tokens:
-        check_attribute(attribute)
-        if type(attribute) == tuple:
+    for attribute in context.attribute_nodes:
+        check_attribute(context, attribute)
+        if isinstance(attribute, Aggregate):
             agg_cnt += 1
     
+    for column in context.group_by_nodes:
+        check_attribute(context, column)
+    for attribute, _ in context.order_by_nodes:
+        check_attribute(context, attribute)
+
     # Aggregate Function Checking
-    if agg_cnt:
-        if agg_cnt > 1:
-            print("AttributeError: Aggregate function supported only on one attribute")
-            exit(1)
-        if len(attribute_tokens) != 1:
-            print("AttributeError: Normal attributes not supported with aggregated attributes")
-            exit(1)
+    if context.group_by_nodes:
+        if context.wildcard_star:
+            raise QueryError("AttributeError: * not supported with GROUP BY")
+        group_by = [get_attribute_name(context, column) for column in context.group_by_nodes]
+        for attribute in context.attribute_nodes:
+            if not isinstance(attribute, Aggregate) and get_attribute_name(context, attribute) not in group_by:
+                raise QueryError("AttributeError: Attribute " + attribute.value + " must be in GROUP BY or aggregated")
+    elif agg_cnt and len(context.attribute_nodes) != agg_cnt:
+        raise QueryError("AttributeError: Normal attributes not supported with aggregated attributes")
 
 
 def check_query_structure(query):
     """Checks query structure for valid queries"""
 
     query = query.split()
+    if not query:
+        raise QueryError("SyntaxError: Empty query\n" + STANDARD_QUERY)
 
     i = 0
+    if query[i].upper() == "EXPLAIN" and len(query) > 1:
+        query = query[1:]
     if query[i].upper() == "SELECT":
         i += 1
         while i < len(query):
@@ -372,49 +2099,387 @@ def check_query_structure(query):
                 break
             i += 1
         if i == len(query):
-            print("SyntaxError: FROM keyword missing")
-            print("Standard Query: select * from table_name where condition;")
-            exit(1)
+            raise QueryError("SyntaxError: FROM keyword missing\n" + STANDARD_QUERY)
         while i < len(query):
             if ";" in query[i]:
                 break
             i += 1
         if i < len(query) - 1:
-            print("InvalidQueryError: Only one SQL statement supported")
-            exit(1)
+            raise QueryError("InvalidQueryError: Only one SQL statement supported")
         if ";" not in query[-1]:
-            print("SyntaxError: Missing semicolon ';' at the end of query")
-            exit(1)
+            raise QueryError("SyntaxError: Missing semicolon ';' at the end of query")
     else:
-        print("SyntaxError: SELECT keyword", "spelt wrong" if query[i].upper() in "SELECT" else "missing")
-        print("Standard Query: select * from table_name where condition;")        
-        exit(1)
+        raise QueryError("SyntaxError: SELECT keyword " + ("spelt wrong" if query[i].upper() in "SELECT" else "missing") + "\n" + STANDARD_QUERY)
+
+
+class Engine:
+    """Runs queries against the tables of files_dir; loaded tables are shared, read-only, by all queries and threads"""
+
+    def __init__(self, files_dir=DIR_PATH, resident_tables=True, plan_cache_size=PLAN_CACHE_SIZE, workers=None, group_limit=GROUP_LIMIT,
+                 distinct_limit=DISTINCT_LIMIT, sort_limit=SORT_LIMIT):
+        self.files_dir = files_dir
+        self.resident_tables = resident_tables # keep loaded tables between queries, reloading them when their csv file changes
+        self.workers = workers or os.cpu_count() or 1 # processes filtering partitions of large tables, 1 filters in this process only
+        self.pool = None
+        self.group_limit = group_limit # groups held in memory by GROUP BY before they are spilled to disk
+        self.distinct_limit = distinct_limit # distinct rows held in memory by DISTINCT before it sorts the rest on disk
+        self.sort_limit = sort_limit # rows sorted in memory by ORDER BY before it merges sorted runs from disk
+        self.tables = None
+        self.metadata_mtime = None
+        self.statistics = {}
+        self.statistics_mtime = None
+        self.lock = threading.Lock()
+        self.plan_cache = OrderedDict() # LRU of ("shape", query shape) or ("query", query) -> plan
+        self.plan_cache_size = plan_cache_size
+        self.plan_cache_hits = 0
+        self.plan_cache_misses = 0
+        self.zone_blocks_scanned = 0
+        self.zone_blocks_skipped = 0
+
+    def load_metadata(self):
+        """Returns table schemas from metadata file, loaded again only if it changed since last load"""
+
+        metadata_path = self.files_dir + "/" + "metadata.txt"
+        try:
+            metadata_mtime = os.stat(metadata_path).st_mtime_ns
+        except OSError:
+            metadata_mtime = None
 
+        with self.lock:
+            if self.tables is None or metadata_mtime != self.metadata_mtime:
+                self.tables = get_tables_metadata(metadata_path)
+                self.metadata_mtime = metadata_mtime
+                self.plan_cache.clear()
+            return self.tables
 
-if __name__ == "__main__":
+    def load_statistics(self):
+        """Returns {table_name: statistics} from statistics file, loaded again only if it changed since last load"""
 
-    if len(sys.argv) != 2:
-        print("Usage: python3 20171171.py \"<query_string>\"")
-        exit(1)
-    
-    query = sys.argv[1]
+        statistics_path = self.files_dir + "/" + STATISTICS_FILE
+        try:
+            statistics_mtime = os.stat(statistics_path).st_mtime_ns
+        except OSError:
+            statistics_mtime = None
+
+        with self.lock:
+            if statistics_mtime != self.statistics_mtime:
+                self.statistics = read_statistics(statistics_path) if statistics_mtime is not None else {}
+                self.statistics_mtime = statistics_mtime
+            return self.statistics
+
+    def get_statistics(self, table_name):
+        """Returns statistics of table, None if it was not analyzed since its csv file last changed"""
+
+        statistics = self.load_statistics().get(table_name)
+        if statistics is None:
+            return None
+        try:
+            csv_stat = os.stat(self.files_dir + "/" + table_name + ".csv")
+        except OSError:
+            return None
+        return statistics if statistics.get("csv") == [csv_stat.st_size, csv_stat.st_mtime_ns] else None
+
+    def analyze(self, table_names=None):
+        """Computes statistics of given tables (all by default) and stores them in the statistics file, returning them"""
+
+        tables = self.load_metadata()
+        table_names = table_names or list(tables)
+        for table_name in table_names:
+            if table_name not in tables:
+                raise QueryError("TableError: Table " + table_name + " does not exist")
+
+        statistics_path = self.files_dir + "/" + STATISTICS_FILE
+        statistics = read_statistics(statistics_path)
+        try:
+            for table_name in table_names:
+                # The csv file is stated before it is read, so statistics of a file changed meanwhile are already stale
+                csv_size, csv_mtime, _ = get_cache_key(self.files_dir, table_name, tables[table_name]["attributes"])
+                statistics[table_name] = analyze_table(self.scan_table(table_name), tables[table_name]["attributes"])
+                statistics[table_name]["csv"] = [csv_size, csv_mtime]
+            write_statistics(statistics_path, statistics)
+        except OSError as e:
+            raise QueryError("TabledataReadingError: " + str(e))
+        return {table_name: statistics[table_name] for table_name in table_names}
+
+    def get_cached_plan(self, query, shape, literals):
+        """Returns cached plan of query bound to its literals, None on a miss"""
+
+        with self.lock:
+            for key in (("shape", shape), ("query", query)):
+                plan = self.plan_cache.get(key)
+                if plan is not None:
+                    self.plan_cache.move_to_end(key)
+                    self.plan_cache_hits += 1
+                    return bind_plan(plan, literals) if key[0] == "shape" else plan
+            self.plan_cache_misses += 1
+        return None
+
+    def cache_plan(self, query, shape, literals, plan):
+        """Caches plan under the shape of query if its literals are the constants it binds, else under query"""
+
+        key = ("shape", shape) if get_plan_constants(plan) == literals else ("query", query)
+        with self.lock:
+            self.plan_cache[key] = plan
+            self.plan_cache.move_to_end(key)
+            while len(self.plan_cache) > self.plan_cache_size:
+                self.plan_cache.popitem(last=False)
+
+    def plan_cache_info(self):
+        """Returns hits, misses and current size of the plan cache"""
+
+        with self.lock:
+            return {"hits": self.plan_cache_hits, "misses": self.plan_cache_misses, "size": len(self.plan_cache)}
+
+    def get_resident_table(self, table_name):
+        """Returns all attributes of table kept loaded between queries, reloading it only when its csv file changes"""
+
+        try:
+            csv_stat = os.stat(self.files_dir + "/" + table_name + ".csv")
+            file_key = (csv_stat.st_size, csv_stat.st_mtime_ns)
+        except OSError:
+            file_key = None
 
-    get_tables_metadata(DIR_PATH + "/" + "metadata.txt")
-    for table_name in TABLES.keys():
-        get_table_data(DIR_PATH, table_name)
+        with self.lock:
+            table = self.tables[table_name]
+            if "data" not in table or table["file_key"] != file_key:
+                table["data"] = read_table_data(self.files_dir, table_name, table["attributes"], table["attributes"])
+                table["zone_map"] = build_zone_map(table["data"])
+                table["file_key"] = file_key
+            return table["data"]
 
-    # print(sqlparse.format(query, reindent=True, keyword_case='upper') + "\n")
-    
-    check_query_structure(query)
-    parser(query)
-    check_misc_errors()
-
-    joined_table = None
-    for table in table_tokens:
-        if joined_table is None:
-            joined_table = TABLES[table.value]
-        else:
-            joined_table = join(joined_table, TABLES[table.value])
+    def get_table_data(self, table_name, attributes=None):
+        """Returns given attributes (all by default) of table"""
+
+        schema = self.tables[table_name]["attributes"]
+        attributes = get_table_attributes(schema, attributes)
+
+        if not self.resident_tables:
+            return read_table_data(self.files_dir, table_name, schema, attributes)
+
+        resident_table = self.get_resident_table(table_name)
+        columns = [resident_table["columns"][resident_table["attributes"].index(attr_name)] for attr_name in attributes]
+        return get_table(attributes, columns, resident_table["size"])
+
+    def scan_table(self, table_name, attributes=None, blocks=None):
+        """Yields given attributes (all by default) of table in batches of BATCH_SIZE rows, only of blocks if given"""
+
+        schema = self.tables[table_name]["attributes"]
+        attributes = get_table_attributes(schema, attributes)
 
-    filtered_output = apply_condition(joined_table)
-    print_output(filtered_output)
+        if not self.resident_tables:
+            yield from scan_table_files(self.files_dir, table_name, schema, attributes, blocks)
+            return
+
+        table_data = self.get_table_data(table_name, attributes)
+        for start, stop in get_zone_runs(blocks, table_data["size"], BATCH_SIZE):
+            yield get_table(attributes, [column[start:stop] for column in table_data["columns"]], stop - start)
+
+    def get_zone_map(self, table_name):
+        """Returns {attribute: (minimums, maximums)} of every block of ZONE_SIZE rows of table, None if it has none"""
+
+        if self.resident_tables:
+            self.get_resident_table(table_name)
+            with self.lock:
+                return self.tables[table_name]["zone_map"]
+
+        schema = self.tables[table_name]["attributes"]
+        cache = open_table_cache(self.files_dir, table_name, schema)
+        return None if cache is None else read_cache_zones(cache, schema)
+
+    def get_zone_blocks(self, table_name, conditions, logical_op):
+        """Returns blocks of table that may satisfy conditions as get_zone_blocks() does, counting scanned and skipped"""
+
+        zone_map = self.get_zone_map(table_name) if conditions else None
+        blocks = None if zone_map is None else get_zone_blocks(zone_map, conditions, logical_op)
+        if blocks is not None:
+            with self.lock:
+                self.zone_blocks_scanned += blocks.count(1)
+                self.zone_blocks_skipped += blocks.count(0)
+        return blocks
+
+    def zone_map_info(self):
+        """Returns numbers of table blocks scanned and skipped by zone maps"""
+
+        with self.lock:
+            return {"scanned": self.zone_blocks_scanned, "skipped": self.zone_blocks_skipped}
+
+    def get_index(self, table_name, attr_name):
+        """Returns (values, row_ids) of index of table attribute if declared in metadata file or created, else None"""
+
+        table = self.tables[table_name]
+        if attr_name not in table["attributes"]:
+            return None
+        try:
+            if attr_name not in table["indexes"] and not os.path.exists(get_index_path(self.files_dir, attr_name)):
+                return None
+            return open_table_index(self.files_dir, table_name, table["attributes"], attr_name)
+        except OSError:
+            return None
+
+    def create_index(self, attr_name):
+        """Builds index of attribute table.attribute, rebuilt whenever the csv file of its table changes"""
+
+        tables = self.load_metadata()
+        table_name = attr_name.partition(".")[0]
+        if table_name not in tables:
+            raise QueryError("TableError: Table " + table_name + " does not exist")
+        if attr_name not in tables[table_name]["attributes"]:
+            raise QueryError("AttributeError: Attribute " + attr_name + " does not exist in given table(s)")
+        try:
+            build_table_index(self.files_dir, table_name, tables[table_name]["attributes"], attr_name)
+        except OSError as e:
+            raise QueryError("TabledataReadingError: " + str(e))
+
+    def get_partitions(self, table_name, attributes=None, blocks=None):
+        """Returns partitions of table read by worker processes from its column cache, None if too small or uncached"""
+
+        # Partitions hold at most PARTITION_SIZE rows, only of the blocks selected by blocks if given
+        if self.workers < 2:
+            return None
+        schema = self.tables[table_name]["attributes"]
+        cache = open_table_cache(self.files_dir, table_name, schema)
+        if cache is None or cache[1] <= PARTITION_SIZE:
+            return None
+
+        attributes = get_table_attributes(schema, attributes)
+        return [(self.files_dir, table_name, schema, attributes, start, stop) for start, stop in get_zone_runs(blocks, cache[1], PARTITION_SIZE)]
+
+    def map_partitions(self, function, partitions, *args):
+        """Yields function(partition, *args) of every partition, computed by the worker processes, in partition order"""
+
+        with self.lock:
+            if self.pool is None:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+            pool = self.pool
+
+        # At most two tasks per worker are pending, so results waiting to be consumed stay bounded
+        pending = deque()
+        try:
+            for partition in partitions:
+                pending.append(pool.submit(function, partition, *args))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        """Stops the worker processes"""
+
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def execute(self, query):
+        """Validates and plans given query, returning QueryResult whose rows are computed as it is iterated; raises QueryError"""
+
+        tables = self.load_metadata()
+        query, shape, literals = normalize_query(query)
+
+        # Repeated queries, also with other literals, skip parsing and validation
+        plan = self.get_cached_plan(query, shape, literals)
+        if plan is None:
+            check_query_structure(query)
+            context = QueryContext(self, tables, parser(query))
+            check_misc_errors(context)
+            plan = plan_query(context)
+            self.cache_plan(query, shape, literals, plan)
+
+        return execute_plan(self, plan)
+
+
+def run_query(engine, query, output=None):
+    """Runs given query in REPL / server mode, where errors must not end the process, printing to output (stdout by default)"""
+
+    try:
+        print_result(engine.execute(query), output)
+    except QueryError as e:
+        print(e, file=output or sys.stdout)
+    except Exception as e:
+        print(type(e).__name__ + ":", str(e), file=output or sys.stdout)
+
+
+def run_repl(engine):
+    """Reads and runs one query per line until EOF or exit"""
+
+    while True:
+        try:
+            query = input("sql> ").strip()
+        except EOFError:
+            print()
+            break
+        if query.lower() in ("exit", "quit"):
+            break
+        if query:
+            run_query(engine, query)
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    """Runs one query per line received and sends back its result terminated by END_OF_RESULT line"""
+
+    def handle(self):
+        for line in self.rfile:
+            query = line.decode(errors="replace").strip() # invalid bytes make a query error, not a dropped connection
+            if not query:
+                continue
+
+            output = io.TextIOWrapper(self.wfile, encoding="utf-8", newline="\n")
+            run_query(self.server.engine, query, output)
+            output.write(END_OF_RESULT + "\n")
+            output.flush()
+            output.detach()
+
+
+def run_server(engine, port):
+    """Serves queries on localhost:port, each connection in its own thread"""
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer(("localhost", port), QueryHandler) as server:
+        server.engine = engine
+        print("Serving queries on localhost:" + str(port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+
+    workers = None
+    if len(sys.argv) > 2 and sys.argv[1] == "--workers" and sys.argv[2].isdigit():
+        workers = int(sys.argv[2])
+        del sys.argv[1:3]
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "--analyze":
+        try:
+            for table_name, statistics in Engine(workers=workers).analyze(sys.argv[2:]).items():
+                print("Analyzed " + table_name + ": " + str(statistics["rows"]) + " rows")
+        except QueryError as e:
+            print(e)
+            sys.exit(e.exit_code)
+    elif len(sys.argv) == 3 and sys.argv[1] == "--create-index":
+        try:
+            Engine(workers=workers).create_index(sys.argv[2])
+        except QueryError as e:
+            print(e)
+            sys.exit(e.exit_code)
+    elif len(sys.argv) == 2 and sys.argv[1] == "--repl":
+        run_repl(Engine(workers=workers))
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == "--server":
+        run_server(Engine(workers=workers), int(sys.argv[2]) if len(sys.argv) == 3 else SERVER_PORT)
+    elif len(sys.argv) != 2:
+        print("Usage: python3 20171171.py [--workers N] \"<query_string>\"")
+        print("       python3 20171171.py [--workers N] --repl")
+        print("       python3 20171171.py [--workers N] --server [port]")
+        print("       python3 20171171.py --create-index table.attribute")
+        print("       python3 20171171.py --analyze [table ...]")
+        sys.exit(1)
+    else:
+        try:
+            print_result(Engine(resident_tables=False, workers=workers).execute(sys.argv[1]))
+        except QueryError as e:
+            print(e)
+            sys.exit(e.exit_code)
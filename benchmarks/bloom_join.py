@@ -0,0 +1,67 @@
+"""Times a join of a large filtered table to few rows of another with and without the Bloom filter of their join keys.
+
+Run from the repository root: python3 benchmarks/bloom_join.py [rows] [workers]
+"""
+
+import importlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+engine_module = importlib.import_module("20171171")
+
+QUERY = "select count(*), sum(Y) from dim, fact where fact.K = dim.K and fact.X > 100;"
+
+
+def write_tables(files_dir, rows):
+    """Writes fact (K, X) of rows rows with rows / 2 distinct keys and dim (K, Y) of rows / 100 rows holding 2% of these keys"""
+
+    random.seed(0)
+    dim_rows = rows // 100
+    with open(files_dir + "/metadata.txt", "w") as metadata_file:
+        metadata_file.write("<begin_table>\nfact\nK\nX\n<end_table>\n<begin_table>\ndim\nK\nY\n<end_table>\n")
+    with open(files_dir + "/fact.csv", "w") as fact_file:
+        fact_file.writelines(str(random.randrange(rows // 2)) + "," + str(random.randrange(1000)) + "\n" for _ in range(rows))
+    with open(files_dir + "/dim.csv", "w") as dim_file:
+        dim_file.writelines(str(key) + "," + str(random.randrange(1000)) + "\n" for key in random.sample(range(rows // 2), dim_rows))
+
+
+def best_time(engine, repeat=5):
+    """Returns (best time in seconds, result rows) of repeat runs of QUERY"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = list(engine.execute(QUERY))
+        times.append(time.perf_counter() - start)
+    return min(times), rows
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as files_dir:
+        write_tables(files_dir, rows)
+        engine = engine_module.Engine(files_dir, workers=workers)
+        try:
+            print("\n".join(line for line, in engine.execute("explain " + QUERY)))
+            best_time(engine, 1) # builds the column caches and starts the workers
+            with_filter, result = best_time(engine)
+            filter_cost = engine_module.BLOOM_FILTER_COST
+            engine_module.BLOOM_FILTER_COST = float("inf")
+            without_filter, expected = best_time(engine)
+            engine_module.BLOOM_FILTER_COST = filter_cost
+        finally:
+            engine.close()
+    if result != expected:
+        raise SystemExit("Results differ: " + str(result) + " " + str(expected))
+    print("rows", rows, "workers", workers)
+    print("bloom filter    %.3fs" % with_filter)
+    print("no bloom filter %.3fs" % without_filter)
+
+
+if __name__ == "__main__":
+    main()